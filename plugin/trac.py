@@ -1,13 +1,38 @@
 # -*- encoding: utf-8 -*-
 
 import os
-import vim
+import sys
+try:
+    import vim
+except ImportError:     # imported by trac_daemon.py
+    vim = None
 import xmlrpclib
 import re
 import codecs
 import datetime
 from time import strftime
 import urllib2
+import zlib
+import socket
+import json
+import time
+import threading
+import bisect
+import Queue
+import csv
+import cookielib
+import httplib
+import hashlib
+import collections
+import functools
+import random
+import contextlib
+import cProfile
+import pstats
+import subprocess
+import shutil
+import urllib
+import errno
 
 
 trac = None
@@ -24,7 +49,994 @@ def truncate_words(text, num_words=10):
     return ' '.join(words[:num_words]) + '...'
 
 
-class HTTPDigestTransport(xmlrpclib.SafeTransport):
+def to_datetime(value):
+    """ Converts an xmlrpc DateTime or unix timestamp to a datetime """
+    if isinstance(value, xmlrpclib.DateTime):
+        v = value.value
+        return datetime.datetime(int(v[0:4]), int(v[4:6]), int(v[6:8]),
+                                 int(v[9:11]), int(v[12:14]), int(v[15:17]))
+    return datetime.datetime.fromtimestamp(value)
+
+
+class Profiler(object):
+    """
+    Splits the time of a command run by :TracProfile into phases. Time is
+    charged to the innermost phase, the rest of the command counts as
+    python. Only vim's thread is measured.
+    """
+    phases = ('rpc', 'unmarshal', 'python', 'write', 'post-write')
+
+    def __init__(self):
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.current_thread()
+        self.totals = dict((name, 0.0) for name in self.phases)
+        self.counts = dict((name, 0) for name in self.phases)
+        self.stack = ['python']
+        self.began = self.mark = time.time()
+
+    def stop(self):
+        self.account()
+        self.thread = None
+        return time.time() - self.began
+
+    def account(self):
+        now = time.time()
+        self.totals[self.stack[-1]] += now - self.mark
+        self.mark = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.thread is not threading.current_thread():
+            yield
+            return
+        self.account()
+        self.counts[name] += 1
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.account()
+            self.stack.pop()
+
+    def summary(self, total):
+        parts = []
+        for name in self.phases:
+            part = '{0} {1:.3f}s'.format(name, self.totals[name])
+            if name == 'rpc':
+                part += ' ({0} requests)'.format(self.counts[name])
+            parts.append(part)
+        return 'Total {0:.3f}s: {1}'.format(total, ', '.join(parts))
+
+
+profiler = Profiler()
+
+
+def batch_size():
+    """ number of calls sent per MultiCall batch """
+    return int(vim.eval('g:tracBatchSize'))
+
+
+def multicall_chunks(server, calls, size=None):
+    """
+    Runs a list of (method, args) calls as chunked MultiCall batches and
+    yields (call, result, error) for each of them. A failing call or batch
+    is reported through error instead of aborting the remaining batches.
+    """
+    if size is None:
+        size = batch_size()
+    for start in xrange(0, len(calls), size):
+        chunk = calls[start:start + size]
+        multicall = xmlrpclib.MultiCall(server)
+        for method, args in chunk:
+            getattr(multicall, method)(*args)
+        try:
+            results = multicall().results
+        except (xmlrpclib.Error, socket.error), e:
+            for call in chunk:
+                yield call, None, e
+            continue
+        for call, result in zip(chunk, results):
+            if isinstance(result, dict):
+                yield call, None, xmlrpclib.Fault(result['faultCode'],
+                                                  result['faultString'])
+            else:
+                yield call, result[0], None
+
+
+def to_unicode(value):
+    """ Decodes the utf-8 strings vim hands over, unicode passes as is """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def query_value(value):
+    """ Escapes the & and | of a value for a trac query string. None for a
+        value starting with !, ~, ^ or $, trac has no way to match those
+        exactly """
+    value = to_unicode(value)
+    if value[:1] in (u'!', u'~', u'^', u'$'):
+        return None
+    return value.replace(u'&', u'\\&').replace(u'|', u'\\|')
+
+
+def vim_list(items):
+    """ Formats strings as a vim list literal, safe for any quotes """
+    quoted = []
+    for item in items:
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        quoted.append("'{0}'".format(item.replace("'", "''")))
+    return '[{0}]'.format(', '.join(quoted))
+
+
+class CompletionIndex(object):
+    """
+    Sorted prefix index over completion candidates with a fuzzy fallback.
+    Candidates are kept as unicode, typed text must be unicode too.
+    """
+    def __init__(self):
+        self.source = None
+        self.keys = []
+        self.last = ('', None)
+
+    def update(self, items):
+        """ Brings the index in line with items touching only the changes """
+        if items == self.source:
+            return
+        # a copy, lists like attachments also change in place
+        self.source = list(items)
+        current = set(key[1] for key in self.keys)
+        new = set(to_unicode(item) for item in items)
+        added = new - current
+        if len(added) > len(self.keys) / 4:
+            self.keys = sorted((item.lower(), item) for item in new)
+        else:
+            for item in current - new:
+                del self.keys[bisect.bisect_left(self.keys,
+                                                 (item.lower(), item))]
+            for item in added:
+                bisect.insort(self.keys, (item.lower(), item))
+        self.last = ('', None)
+
+    def complete(self, typed, limit):
+        """ Returns up to limit candidates, prefix matches first and then
+            the tightest fuzzy matches """
+        lower = typed.lower()
+        matches = []
+        for i in xrange(bisect.bisect_left(self.keys, (lower,)),
+                        len(self.keys)):
+            key, item = self.keys[i]
+            if not key.startswith(lower) or len(matches) == limit:
+                break
+            matches.append(item)
+        if lower and len(matches) < limit:
+            found = set(matches)
+            for item in self.fuzzy(lower):
+                if len(matches) == limit:
+                    break
+                if item not in found:
+                    matches.append(item)
+        return matches
+
+    def fuzzy(self, lower):
+        """ Candidates containing the typed characters in order, ranked by
+            how close together they are """
+        previous, candidates = self.last
+        if candidates is None or not lower.startswith(previous):
+            candidates = self.keys
+        pattern = re.compile('.*?'.join(re.escape(c) for c in lower))
+        scored = []
+        for key in candidates:
+            m = pattern.search(key[0])
+            if m:
+                scored.append((m.end() - m.start(), m.start(), key))
+        self.last = (lower, [score[2] for score in scored])
+        scored.sort()
+        return [score[2][1] for score in scored]
+
+
+def run_in_background(func, *args):
+    """ Runs func in a daemon thread. func must not call into vim. Failures
+        are ignored, the work is only ever an optimisation """
+    def target():
+        try:
+            func(*args)
+        except Exception:
+            pass
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def in_parallel(func, jobs, proxies):
+    """ Runs func(proxy, job) for every job on one thread per proxy and
+        returns the results in the order of jobs. func must not call into
+        vim, a job that raises gets None """
+    results = [None] * len(jobs)
+    queue = Queue.Queue()
+    for job in enumerate(jobs):
+        queue.put(job)
+
+    def work(proxy):
+        while True:
+            try:
+                index, job = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(proxy, job)
+            except Exception:
+                pass
+    threads = [threading.Thread(target=work, args=(proxy, ))
+               for proxy in proxies[:len(jobs)]]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def checksum(data):
+    """ md5 hex digest of a page as it is stored in a file """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return hashlib.md5(data).hexdigest()
+
+
+def wiki_links(text):
+    """ Names of the pages a wiki text links to: CamelCase words that are
+        not escaped with ! and wiki: links, outside of {{{ }}} blocks """
+    text = re.sub(r'(?s)\{\{\{.*?\}\}\}', '', text)
+    links = set()
+    for match in re.finditer(r'\bwiki:"?([^\s\]\["#?]+)|(?<![!\w/.])'
+                             r'((?:[A-Z][a-z0-9]+){2,}(?:/\w+)*)', text):
+        links.add(match.group(1) or match.group(2))
+    return links
+
+
+def xmlrpc_strings(value):
+    """ Turns unicode strings (from json, csv...) into the ascii str values
+        xmlrpclib returns where possible """
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, list):
+        return [xmlrpc_strings(v) for v in value]
+    if isinstance(value, dict):
+        return dict((xmlrpc_strings(k), xmlrpc_strings(v))
+                    for k, v in value.iteritems())
+    return value
+
+
+class DiskCache(object):
+    """ Stores json values in files under a per server directory """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, '{0}.json'.format(name))
+
+    def load(self, name):
+        """ Returns the stored value and its age in seconds """
+        path = self.path(name)
+        try:
+            with open(path) as fp:
+                value = xmlrpc_strings(json.load(fp))
+            return value, time.time() - os.path.getmtime(path)
+        except (IOError, OSError, ValueError):
+            return None, None
+
+    def store(self, name, value):
+        """ Writes a value, errors are ignored as the cache is optional. A
+            value json cannot hold (xmlrpclib.DateTime...) is not stored """
+        path = self.path(name)
+        try:
+            data = json.dumps(value)
+        except (TypeError, ValueError):
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path + '.tmp', 'w') as fp:
+                fp.write(data)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            pass
+
+
+class AttachmentStore(object):
+    """
+    Content addressed copies of the attachments downloaded or uploaded. An
+    index maps each attachment (ticket:<id>/<file> or wiki:<page>/<file>) to
+    the sha1 of its content and the size and time the server reported for
+    it. A copy stands for the attachment while those still match.
+    """
+    def __init__(self, disk_cache):
+        self.disk_cache = disk_cache
+        self.directory = os.path.join(disk_cache.directory, 'attachments')
+        self.index = disk_cache.load('attachments')[0] or {}
+
+    def blob(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def lookup(self, key, meta):
+        """ Path of the copy of an attachment the server still holds """
+        entry = self.index.get(key)
+        if (entry and meta and [entry['size'], entry['time']] == meta and
+                os.path.exists(self.blob(entry['sha1']))):
+            return self.blob(entry['sha1'])
+
+    def unchanged(self, key, meta, data):
+        """ Whether the server already holds data as this attachment """
+        entry = self.index.get(key)
+        return bool(entry and meta and
+                    [entry['size'], entry['time']] == meta and
+                    entry['sha1'] == hashlib.sha1(data).hexdigest())
+
+    def add(self, key, meta, data):
+        """ Stores data as the attachment, returns the path of the copy """
+        path = os.path.join(self.directory, 'incoming')
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path, 'wb') as fp:
+                fp.write(data)
+        except (IOError, OSError):
+            return None
+        return self.add_file(key, meta, path, hashlib.sha1(data).hexdigest())
+
+    def add_file(self, key, meta, source, digest):
+        """ Moves the file source with the given sha1 into the store as the
+            attachment. Blobs no longer referenced by the index are removed.
+            Returns the path of the copy """
+        path = self.blob(digest)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if os.path.exists(path):
+                os.remove(source)
+            else:
+                os.rename(source, path)
+        except OSError:
+            return None
+        old = self.index.get(key)
+        self.index[key] = {'sha1': digest, 'size': meta[0], 'time': meta[1]}
+        if old and not any(entry['sha1'] == old['sha1']
+                           for entry in self.index.itervalues()):
+            try:
+                os.remove(self.blob(old['sha1']))
+                os.rmdir(os.path.dirname(self.blob(old['sha1'])))
+            except OSError:     # the directory holds other blobs
+                pass
+        self.disk_cache.store('attachments', self.index)
+        return path
+
+    def get(self, session, key, path, meta, rpc):
+        """ An attachment as (path of its copy, None), or (None, data) when
+            it could not be stored. A copy matching meta is used as it is,
+            otherwise the attachment is streamed from path on the web session
+            and rpc() only gets it when that path cannot be used """
+        copy = self.lookup(key, meta)
+        if copy:
+            return copy, None
+        if meta:
+            copy = self.download(session, key, path, meta)
+            if copy:
+                return copy, None
+        data = rpc()
+        copy = self.add(key, meta, data) if meta else None
+        return copy, None if copy else data
+
+    def download(self, session, key, path, meta):
+        """
+        Streams an attachment from its raw-attachment path into the store and
+        returns the path of the copy. What an interrupted download left is
+        kept, for a later call too, and resumed with a Range request until the
+        attachment changes. Network errors are raised once three attempts
+        failed, None is returned when the raw path cannot be used.
+        """
+        partial = os.path.join(self.directory, 'partial',
+                               hashlib.sha1(json.dumps(key)).hexdigest())
+        try:
+            if not os.path.isdir(os.path.dirname(partial)):
+                os.makedirs(os.path.dirname(partial))
+            if os.path.exists(partial):
+                with open(partial + '.json') as fp:
+                    if json.load(fp) != meta:
+                        os.remove(partial)
+            with open(partial + '.json', 'w') as fp:
+                json.dump(meta, fp)
+        except (IOError, OSError, ValueError):
+            self.discard(partial)
+            return None
+        digest, size, error = None, 0, None
+        # a dropped connection is picked up where it stopped
+        for attempt in xrange(3):
+            offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+            headers = {'Accept-Encoding': 'identity'}
+            if offset:
+                headers['Range'] = 'bytes={0}-'.format(offset)
+            try:
+                response = session.open(path, headers)
+            except urllib2.HTTPError, e:
+                if e.code != 416:
+                    return None
+                if offset != meta[0]:
+                    self.discard(partial)
+                    return None
+                response = None     # complete already
+            except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+                error = e
+                continue
+            if response and response.getcode() != 206:
+                offset = 0
+            digest = hashlib.sha1()
+            try:
+                with open(partial, 'r+b' if offset else 'wb') as fp:
+                    if offset:
+                        for chunk in iter(lambda: fp.read(65536), ''):
+                            digest.update(chunk)
+                        fp.seek(offset)
+                    while response:
+                        chunk = response.read(65536)
+                        if not chunk:
+                            break
+                        fp.write(chunk)
+                        digest.update(chunk)
+            except (httplib.HTTPException, socket.error), e:
+                error = e   # the next attempt resumes from what was written
+            size = os.path.getsize(partial)
+            if size >= meta[0]:
+                break
+        else:
+            raise error or httplib.IncompleteRead('', meta[0] - size)
+        if size != meta[0]:
+            self.discard(partial)
+            return None
+        os.remove(partial + '.json')
+        return self.add_file(key, meta, partial, digest.hexdigest())
+
+    def discard(self, partial):
+        """ Removes a partial download """
+        for path in (partial, partial + '.json'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def url_quote(name):
+    """ Quotes a page or file name for a url path """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return urllib.quote(name)
+
+
+def file_digest(path):
+    """ sha1 hex digest of a file, read in chunks """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_attachment(file_name, data=None, copy=None):
+    """ Writes a downloaded attachment to the current directory, or a copy
+        from the attachment store. Existing files are only replaced by
+        themselves """
+    if os.path.exists(file_name):
+        if copy:
+            same = file_digest(file_name) == file_digest(copy)
+        else:
+            same = file_digest(file_name) == hashlib.sha1(data).hexdigest()
+        if same:
+            print '{0} is up to date'.format(file_name)
+        else:
+            print "Will not overwrite existing file {0}".format(file_name)
+    elif copy:
+        shutil.copyfile(copy, file_name)
+    else:
+        with open(file_name, 'wb') as fp:
+            fp.write(data)
+
+
+def approximate_size(value):
+    """ Rough number of bytes held by a cached value """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for item in value.iteritems():
+            size += approximate_size(item[0]) + approximate_size(item[1])
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            size += approximate_size(item)
+    return size
+
+
+class LRUCache(object):
+    """
+    In memory cache bounded by the approximate size of its values. The least
+    recently used entries are evicted once budget bytes are exceeded and
+    entries older than ttl seconds are dropped (0 keeps them), unless they
+    were stored as not expiring. Only used from vim's thread.
+    """
+    def __init__(self, budget, ttl=0):
+        self.budget = budget
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.expired = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is not None and self.expired_entry(entry):
+            self.size -= entry[1]
+            self.expired += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and not self.expired_entry(entry)
+
+    def expired_entry(self, entry):
+        return (self.ttl and entry[2] is not None and
+                time.time() - entry[2] > self.ttl)
+
+    def put(self, key, value, expires=True):
+        """ Stores a value, values larger than the whole budget are not.
+            Values that can never change are stored with expires=False """
+        self.discard(key)
+        size = approximate_size(value)
+        if size > self.budget:
+            return
+        self.entries[key] = (value, size, time.time() if expires else None)
+        self.size += size
+        while self.size > self.budget:
+            self.size -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return ('{0} entries, {1}/{2} KB, {3} hits, {4} misses, {5} evicted, '
+                '{6} expired'.format(len(self.entries), self.size / 1024,
+                                     self.budget / 1024, self.hits,
+                                     self.misses, self.evictions, self.expired))
+
+
+class ServerUnavailable(socket.error):
+    """ Raised without contacting a server that keeps failing """
+
+
+class RequestScope(object):
+    """
+    Wraps the server proxy used from vim's thread. While a command runs
+    (see command) identical reads are sent once and their results reused,
+    also inside MultiCalls where only the calls not answered yet are sent.
+    Writes forget the results they affect, the ticket returned by
+    ticket.update is kept as the result of ticket.get.
+
+    Reads failing on the network are retried with jittered back-off. After
+    failure_threshold failures in a row requests fail at once for cooldown
+    seconds, then a single request is let through to probe the server.
+    """
+    # read results that depend on more than their first argument
+    listings = ('ticket.query', 'ticket.getRecentChanges',
+                'wiki.getRecentChanges')
+    network_errors = (socket.error, httplib.HTTPException, urllib2.URLError,
+                      xmlrpclib.ProtocolError)
+    failure_threshold = 3
+    cooldown = 30
+
+    def __init__(self, proxy, retries=0):
+        self.proxy = proxy
+        self.retries = retries
+        self.memo = None
+        self.depth = 0
+        self.failures = 0
+        self.opened = 0
+
+    def __enter__(self):
+        if not self.depth:
+            self.memo = {}
+        self.depth += 1
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if not self.depth:
+            self.memo = None
+
+    def __getattr__(self, name):
+        return ScopedMethod(self, name)
+
+    def is_write(self, name):
+        return re.match(r'(create|update|delete|put)', name.split('.')[-1])
+
+    def close(self):
+        """ Drops the connection, it is unusable after an interrupted call """
+        self.proxy('close')()
+
+    def send(self, name, args, retry):
+        """ Sends a request unless the circuit is open, retrying reads """
+        if (self.failures >= self.failure_threshold and
+                time.time() < self.opened + self.cooldown):
+            raise ServerUnavailable('server not responding, retrying in '
+                                    '{0:.0f}s'.format(self.opened +
+                                                      self.cooldown -
+                                                      time.time()))
+        attempt = 0
+        while True:
+            try:
+                with profiler.phase('rpc'):
+                    result = getattr(self.proxy, name)(*args)
+            except self.network_errors, e:
+                self.close()
+                if (isinstance(e, xmlrpclib.ProtocolError) and
+                        e.errcode < 500):
+                    raise
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened = time.time()
+                    raise
+                if not retry or attempt >= self.retries:
+                    raise
+                attempt += 1
+                time.sleep(0.5 * 2 ** attempt * random.uniform(0.5, 1.5))
+                continue
+            self.failures = 0
+            return result
+
+    def call(self, name, args):
+        if name == 'system.multicall':
+            return self.multicall(args[0])
+        if self.is_write(name):
+            result = self.send(name, args, False)
+            if self.memo is not None:
+                self.forget(name, args, result)
+            return result
+        if self.memo is None:
+            return self.send(name, args, True)
+        key = (name, repr(args))
+        # the daemon shares memo between threads, look it up only once
+        entry = self.memo.get(key)
+        if entry is None:
+            entry = (args, self.send(name, args, True))
+            self.memo[key] = entry
+        return entry[1]
+
+    def multicall(self, calls):
+        """ system.multicall sending only what is not remembered yet, in
+            order and each identical read once """
+        retry = not any(self.is_write(c['methodName']) for c in calls)
+        if self.memo is None:
+            return self.send('system.multicall', (calls, ), retry)
+        results = [None] * len(calls)
+        sent, first, duplicates = [], {}, []
+        write_seen = False
+        for i, call in enumerate(calls):
+            name, args = call['methodName'], tuple(call['params'])
+            key = (name, repr(args))
+            write_seen = write_seen or self.is_write(name)
+            entry = None if write_seen else self.memo.get(key)
+            if write_seen:
+                sent.append(i)
+            elif entry is not None:
+                results[i] = [entry[1]]
+            elif key in first:
+                duplicates.append((i, first[key]))
+            else:
+                first[key] = i
+                sent.append(i)
+        if sent:
+            answers = self.send('system.multicall',
+                                ([calls[i] for i in sent], ), retry)
+            for i, result in zip(sent, answers):
+                results[i] = result
+                if isinstance(result, dict):    # fault
+                    continue
+                name, args = calls[i]['methodName'], tuple(calls[i]['params'])
+                if self.is_write(name):
+                    self.forget(name, args, result[0])
+                else:
+                    self.memo[(name, repr(args))] = (args, result[0])
+        for i, j in duplicates:
+            results[i] = results[j]
+        return results
+
+    def forget(self, name, args, result):
+        """ Drops the remembered reads of the realm of a write about the
+            same page/ticket as well as listings """
+        realm = name.split('.')[0] + '.'
+        target = args[:1]
+        if name == 'wiki.putAttachment' or name == 'wiki.putAttachmentEx':
+            target = (args[0].rsplit('/', 1)[0], )
+        for key, (key_args, value) in self.memo.items():
+            if key[0].startswith(realm) and (key_args[:1] in ((), target) or
+                                              key[0] in self.listings):
+                self.memo.pop(key, None)
+        if name == 'ticket.update':
+            self.memo[('ticket.get', repr(target))] = (target, result)
+
+
+class ScopedMethod(object):
+    """ A (possibly dotted) method of a RequestScope """
+    def __init__(self, scope, name):
+        self.scope = scope
+        self.name = name
+
+    def __getattr__(self, name):
+        return ScopedMethod(self.scope, '{0}.{1}'.format(self.name, name))
+
+    def __call__(self, *args):
+        return self.scope.call(self.name, args)
+
+
+def command(method):
+    """ Runs a Trac method in a request scope of the current server. When it
+        is cancelled with Ctrl-C or the server fails the ticket list
+        settings are restored and the error is reported """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        server = self.server
+        state = self.list_state()
+        with server:
+            try:
+                return method(self, *args, **kwargs)
+            except (KeyboardInterrupt, ) + RequestScope.network_errors, e:
+                if server.depth > 1:
+                    raise
+                server.close()
+                self.restore_list_state(state)
+                if isinstance(e, KeyboardInterrupt):
+                    print 'Cancelled.'
+                else:
+                    print 'Request failed: {0}'.format(e)
+    return wrapper
+
+
+def server_proxy(url):
+    """ Builds an xmlrpc proxy for a g:tracServerList entry. Its timeouts
+        must be numbers already """
+    url = dict({'scheme': 'http', 'rpc_path': 'login/rpc'}, **url)
+    scheme = url['scheme']
+    auth = url.get('auth', '').split(':')
+    threshold = url.get('gzip_threshold')
+
+    if len(auth) == 2:  # Basic authentication
+        uri = '{scheme}://{auth}@{server}{rpc_path}'.format(**url)
+    else:   # Anonymous or Digest authentication
+        uri = '{scheme}://{server}{rpc_path}'.format(**url)
+    if len(auth) == 3:  # Digest authentication
+        transport = HTTPDigestTransport(scheme, *auth)
+    elif scheme == 'https':
+        transport = GzipSafeTransport()
+    else:
+        transport = GzipTransport()
+    if threshold:
+        transport.encode_threshold = int(threshold)
+    transport.connect_timeout = url.get('connect_timeout')
+    transport.read_timeout = url.get('read_timeout')
+    return xmlrpclib.ServerProxy(uri, transport=transport)
+
+
+def remember(history, item):
+    """ Adds item to a visited history, forgetting the oldest entries beyond
+        g:tracHistoryLimit """
+    if item in history:
+        return
+    history.append(item)
+    del history[:-int(vim.eval('g:tracHistoryLimit'))]
+
+
+def gzip_compress(data):
+    """ gzip encodes a request body """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipDecodedStream(object):
+    """ File like wrapper inflating a gzip encoded response as it is read """
+    def __init__(self, stream):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=None):
+        """ Returns the next inflated chunk, or the whole rest of the body
+            when no size is given like file.read() """
+        if size is None or size < 0:
+            return ''.join(iter(lambda: self.read(8192), ''))
+        while True:
+            data = self.stream.read(size)
+            if not data:
+                return self.decompressor.flush()
+            data = self.decompressor.decompress(data)
+            if data:
+                return data
+
+    def __iter__(self):
+        """ Yields the inflated body line by line """
+        pending = ''
+        while True:
+            data = self.read(8192)
+            if not data:
+                break
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+
+class TracSession(object):
+    """
+    urllib2 session on the web frontend of a trac site using the xmlrpc
+    credentials. The trac_auth cookie is obtained from /login once.
+    """
+    def __init__(self, url, timeout=None):
+        self.base = '{scheme}://{server}'.format(**url).rstrip('/')
+        self.timeout = timeout
+        auth = url['auth'].split(':')
+        handlers = [urllib2.HTTPCookieProcessor(cookielib.CookieJar())]
+        if len(auth) == 2:
+            passwords = urllib2.HTTPPasswordMgrWithDefaultRealm()
+            passwords.add_password(None, self.base, *auth)
+            handlers.append(urllib2.HTTPBasicAuthHandler(passwords))
+        elif len(auth) == 3:
+            handlers.append(urllib2.HTTPDigestAuthHandler())
+            handlers[-1].add_password(auth[2], self.base, *auth[:2])
+        self.opener = urllib2.build_opener(*handlers)
+        self.logged_in = len(auth) < 2
+
+    def open(self, path, headers={}, method=None):
+        """ Opens a path below the site, the response body is inflated as
+            it is read when the server gzipped it """
+        if not self.logged_in:
+            self.opener.open(self.base + '/login', timeout=self.timeout).read()
+            self.logged_in = True
+        request = urllib2.Request(self.base + path)
+        if method:
+            request.get_method = lambda: method
+        request.add_header('Accept-Encoding', 'gzip')
+        for header in headers.iteritems():
+            request.add_header(*header)
+        with profiler.phase('rpc'):
+            response = self.opener.open(request, timeout=self.timeout)
+        if response.info().get('Content-Encoding') == 'gzip':
+            return GzipDecodedStream(response)
+        return response
+
+
+class GzipTransportMixin:
+    """
+    Negotiates gzip compressed bodies and parses responses as they stream in.
+    """
+    # request bodies larger than this many bytes are gzipped, None disables
+    encode_threshold = None
+    # seconds to wait for a connection and for each read, None waits forever
+    connect_timeout = None
+    read_timeout = None
+
+    def timed(self, connection):
+        """ Applies the timeouts to a (cached) httplib connection """
+        if not getattr(connection, 'timed', False):
+            connect = connection.connect
+
+            def timed_connect():
+                connection.timeout = self.connect_timeout
+                connect()
+                connection.sock.settimeout(self.read_timeout)
+            connection.connect = timed_connect
+            connection.timed = True
+        return connection
+
+    def compress_body(self, request_body):
+        """ returns the body to send and whether it was gzipped """
+        if (self.encode_threshold is not None and
+                len(request_body) > self.encode_threshold):
+            return gzip_compress(request_body), True
+        return request_body, False
+
+    def send_request(self, connection, handler, request_body):
+        connection.putrequest("POST", handler, skip_accept_encoding=True)
+        connection.putheader("Accept-Encoding", "gzip")
+
+    def send_content(self, connection, request_body):
+        connection.putheader("Content-Type", "text/xml")
+        request_body, compressed = self.compress_body(request_body)
+        if compressed:
+            connection.putheader("Content-Encoding", "gzip")
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders(request_body)
+
+    def parse_response(self, response):
+        if hasattr(response, 'getheader'):
+            encoding = response.getheader('Content-Encoding', '')
+        else:
+            encoding = response.info().get('Content-Encoding', '')
+        if encoding == 'gzip':
+            stream = GzipDecodedStream(response)
+        else:
+            stream = response
+
+        p, u = self.getparser()
+        while True:
+            data = stream.read(8192)
+            if not data:
+                break
+            with profiler.phase('unmarshal'):
+                p.feed(data)
+        with profiler.phase('unmarshal'):
+            p.close()
+            return u.close()
+
+
+class GzipTransport(GzipTransportMixin, xmlrpclib.Transport):
+    """ Plain http transport with gzip support """
+    def make_connection(self, host):
+        return self.timed(xmlrpclib.Transport.make_connection(self, host))
+
+
+class GzipSafeTransport(GzipTransportMixin, xmlrpclib.SafeTransport):
+    """ https transport with gzip support """
+    def make_connection(self, host):
+        return self.timed(xmlrpclib.SafeTransport.make_connection(self, host))
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """ http over a unix socket """
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class DaemonTransport(GzipTransport):
+    """
+    Sends the requests for a server to trac_daemon.py listening on a unix
+    socket. The server's g:tracServerList entry travels in a header.
+    """
+    def __init__(self, path, upstream):
+        GzipTransport.__init__(self)
+        self.path = path
+        self.upstream = json.dumps(upstream)
+
+    def make_connection(self, host):
+        if self._connection[1] is None:
+            self._connection = host, UnixHTTPConnection(self.path,
+                                                        self.read_timeout)
+        return self._connection[1]
+
+    def send_request(self, connection, handler, request_body):
+        GzipTransport.send_request(self, connection, handler, request_body)
+        connection.putheader('X-Trac-Upstream', self.upstream)
+
+
+class HTTPDigestTransport(GzipTransportMixin, xmlrpclib.SafeTransport):
     """
     Transport that uses urllib2 so that we can do Digest authentication.
     """
@@ -39,16 +1051,21 @@ class HTTPDigestTransport(xmlrpclib.SafeTransport):
     def request(self, host, handler, request_body, verbose):
         url = '{scheme}://{host}{handler}'.format(scheme=self.scheme,
                                                   host=host, handler=handler)
+        request_body, compressed = self.compress_body(request_body)
         request = urllib2.Request(url)
         request.add_data(request_body)
         request.add_header("User-Agent", self.user_agent)
         request.add_header("Content-Type", "text/xml")
+        request.add_header("Accept-Encoding", "gzip")
+        if compressed:
+            request.add_header("Content-Encoding", "gzip")
 
         authhandler = urllib2.HTTPDigestAuthHandler()
         authhandler.add_password(self.realm, url, self.username, self.password)
         opener = urllib2.build_opener(authhandler)
 
-        f = opener.open(request)
+        # urllib2 has a single timeout for connecting and reading
+        f = opener.open(request, timeout=self.read_timeout)
         return self.parse_response(f)
 
 
@@ -73,13 +1090,26 @@ class VimWindow(object):
         if not isinstance(msg, basestring):
             msg = str(msg)
         msg = msg.encode('utf-8', 'ignore')
+        with profiler.phase('write'):
+            self.prepare()
+            if not append:
+                self.buffer[:] = msg.split('\n')
+            else:
+                self.buffer.append(msg.split('\n'))
+            self.command('normal gg')
+        with profiler.phase('post-write'):
+            self.on_write()
+
+    def extend(self, lines, clear=False):
+        """ appends lines without the on_write pass, for text arriving in
+            parts that a final write then replaces """
+        lines = [line.encode('utf-8', 'ignore') for line
+                 in '\n'.join(lines).split('\n')]
         self.prepare()
-        if not append:
-            self.buffer[:] = msg.split('\n')
+        if clear:
+            self.buffer[:] = lines
         else:
-            self.buffer.append(msg.split('\n'))
-        self.command('normal gg')
-        self.on_write()
+            self.buffer.append(lines)
 
     def on_write(self):
         """ for vim commands after a write is made to a buffer """
@@ -128,6 +1158,18 @@ class VimWindow(object):
 
 
 class NonEditableWindow(VimWindow):
+    def write(self, msg, append=False):
+        """ buffers are made modifiable again to be rewritten in place """
+        self.prepare()
+        vim.command("setlocal modifiable")
+        VimWindow.write(self, msg, append)
+
+    def extend(self, lines, clear=False):
+        self.prepare()
+        vim.command("setlocal modifiable")
+        VimWindow.extend(self, lines, clear)
+        vim.command("setlocal nomodifiable")
+
     def on_write(self):
         vim.command("setlocal nomodifiable")
 
@@ -153,6 +1195,14 @@ class UI(object):
 
 class TracWiki(object):
     """ Trac Wiki Class """
+    # pages left out of the toc when g:tracHideTracWiki is yes
+    hidden_pages = re.compile(r'^(Trac|Wiki)|^(InterMapTxt|InterWiki|SandBox|'
+                              r'InterTrac|TitleIndex|RecentChanges|CamelCase)$')
+    # revisions fetched ahead on each side of the one in the diff split
+    prefetch_depth = 2
+    # seconds a prefetched page may be shown before it is fetched again
+    prefetch_ttl = 60
+
     def __init__(self):
         self.reset_attrs()
 
@@ -161,37 +1211,352 @@ class TracWiki(object):
         self.revision = 1
         self.current_page = False
         self.visited_pages = []
+        self.watched = []
+        self.attachments = []
+        self.history = []
+        self.diff_revision = None
+        self.prefetching = set()
+        self.links = {}
+        self.toc_tree = None
+        self.toc_index = []
+        self.toc_expanded = set()
 
     def get_all_pages(self):
         """ Gets a List of Wiki Pages """
-        self.pages = trac.server.wiki.getAllPages()
-        return "\n".join(self.pages)
+        self.set_pages(trac.server.wiki.getAllPages())
+        return self.pages
+
+    def set_pages(self, pages):
+        """ Replaces the page list, the toc is rebuilt when it changed.
+            Links of pages that no longer exist are forgotten """
+        if pages != self.pages:
+            self.pages = pages
+            self.toc_tree = None
+            existing = set(pages)
+            for name in self.links.keys():
+                if name not in existing:
+                    del self.links[name]
+                else:
+                    self.links[name] = [link for link in self.links[name]
+                                        if link in existing]
+
+    def build_toc(self):
+        """ Filters hidden pages and sorts the rest into a tree by path
+            segment. Nodes are [is_page, {name: node}, [names]] """
+        hide = vim.eval('tracHideTracWiki') == 'yes'
+        self.toc_tree = [False, {}, []]
+        for page in sorted(self.pages, key=lambda p: p.split('/')):
+            if page == 'WikiStart' or hide and self.hidden_pages.match(page):
+                continue
+            node = self.toc_tree
+            for part in page.split('/'):
+                if part not in node[1]:
+                    node[1][part] = [False, {}, []]
+                    node[2].append(part)
+                node = node[1][part]
+            node[0] = True
+
+    def render_toc(self):
+        """ Renders the expanded part of the page tree. toc_index holds the
+            (path, is_page, has_children) of each line """
+        if self.toc_tree is None:
+            self.build_toc()
+        lines = ['WikiStart']
+        self.toc_index = [('WikiStart', True, False)]
+
+        def walk(node, prefix, depth):
+            for name in node[2]:
+                is_page, children, names = node[1][name]
+                path = prefix + name
+                expanded = path in self.toc_expanded
+                if not names:
+                    marker = '  '
+                elif expanded:
+                    marker = '- '
+                else:
+                    marker = '+ '
+                lines.append('{0}{1}{2}'.format('  ' * depth, marker, name))
+                self.toc_index.append((path, is_page, bool(names)))
+                if names and expanded:
+                    walk(node[1][name], path + '/', depth + 1)
+
+        walk(self.toc_tree, '', 0)
+        return '\n'.join(lines)
+
+    def toc_entry(self, line=None):
+        """ (path, is_page, has_children) of a toc line, default current """
+        if line is None:
+            line = vim.current.window.cursor[0] - 1
+        try:
+            return self.toc_index[line]
+        except IndexError:
+            return (None, False, False)
+
+    def toggle_toc(self, path):
+        """ Expands or collapses a toc node """
+        if path in self.toc_expanded:
+            self.toc_expanded.remove(path)
+        else:
+            self.toc_expanded.add(path)
+        return self.render_toc()
+
+    def reveal_toc(self, page):
+        """ Expands the ancestors of a page so it shows in the toc """
+        parts = page.split('/')
+        for i in xrange(1, len(parts)):
+            self.toc_expanded.add('/'.join(parts[:i]))
+
+    def mirror_file(self, directory, name):
+        """ The file a page is mirrored to, subpages go in subdirectories.
+            None for a name that would lead outside directory """
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        parts = name.split('/')
+        if any(part in ('', '.', '..') or os.sep in part or
+               (os.altsep and os.altsep in part) for part in parts):
+            return None
+        return os.path.join(directory, *'{0}.wiki'.format(name).split('/'))
+
+    def mirror_pages(self, directory):
+        """ Names and contents of the .wiki files under a mirror """
+        files = {}
+        for root, dirs, names in os.walk(directory):
+            for file_name in names:
+                if not file_name.endswith('.wiki'):
+                    continue
+                path = os.path.join(root, file_name)
+                name = os.path.relpath(path, directory)[:-5]
+                try:
+                    name = name.replace(os.sep, '/').decode('utf-8')
+                except UnicodeDecodeError:
+                    continue
+                name = xmlrpc_strings(name)
+                with open(path) as fp:
+                    files[name] = fp.read()
+        return files
+
+    def export(self, directory, proxies):
+        """ Mirrors every page to a .wiki file under directory. Only pages
+            that are new or have a new version since the last export are
+            downloaded, in MultiCall batches spread over the proxies. Files
+            edited since the last export are left alone. Returns the lists of
+            written, conflicting, removed and failed pages """
+        cache = DiskCache(directory)
+        manifest = cache.load('.mirror')[0] or {'since': None, 'pages': {}}
+        known = manifest['pages']
+
+        multicall = xmlrpclib.MultiCall(trac.server)
+        multicall.wiki.getAllPages()
+        if manifest['since']:
+            multicall.wiki.getRecentChanges(
+                    xmlrpclib.DateTime(manifest['since']))
+        results = list(multicall())
+        pages = results[0]
+        changed = set(p for p in pages if p not in known)
+        for info in (results[1] if manifest['since'] else []):
+            if info['version'] != known.get(info['name'], {}).get('version'):
+                changed.add(info['name'])
+        changed.intersection_update(pages)
+        unsafe = [p for p in changed if not self.mirror_file(directory, p)]
+        changed.difference_update(unsafe)
+
+        def fetch(proxy, names):
+            calls = []
+            for name in names:
+                calls.extend([('wiki.getPage', (name, )),
+                              ('wiki.getPageInfo', (name, ))])
+            results = [r[1] for r in multicall_chunks(proxy, calls, len(calls))]
+            return zip(names, results[0::2], results[1::2])
+
+        changed = sorted(changed)
+        size = batch_size()
+        batches = [changed[i:i + size] for i in xrange(0, len(changed), size)]
+        written, conflicts, removed, failed = [], [], [], []
+        # conflicting pages must show up in the next getRecentChanges again
+        since, conflict_since = manifest['since'], None
+        for batch, fetched in zip(batches, in_parallel(fetch, batches,
+                                                       proxies)):
+            for name, text, info in fetched or [(n, None, None) for n in batch]:
+                if text is None or info is None:
+                    failed.append(name)
+                    continue
+                path = self.mirror_file(directory, name)
+                previous = known.get(name, {}).get('checksum')
+                modified = info['lastModified'].value
+                since = max(since, modified)
+                if os.path.exists(path):
+                    with open(path) as fp:
+                        current = checksum(fp.read())
+                    if current not in (previous, checksum(text)):
+                        conflicts.append(name)
+                        conflict_since = min(conflict_since or modified,
+                                             modified)
+                        continue
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with codecs.open(path, 'w', 'utf-8') as fp:
+                    fp.write(text)
+                known[name] = {'version': info['version'],
+                               'checksum': checksum(text)}
+                written.append(name)
+                self.note_links(name, text)
+        if conflict_since:
+            since = max(manifest['since'], min(since, conflict_since))
+        # nothing is known about when a page that failed changed
+        if failed:
+            since = manifest['since']
+        manifest['since'] = since
+        failed.extend(sorted(unsafe))
+
+        for name in set(known) - set(pages):
+            path = self.mirror_file(directory, name)
+            if os.path.exists(path):
+                with open(path) as fp:
+                    if checksum(fp.read()) != known[name]['checksum']:
+                        conflicts.append(name)
+                        continue
+                os.remove(path)
+            del known[name]
+            removed.append(name)
+            self.links.pop(name, None)
+        cache.store('.mirror', manifest)
+        return written, conflicts, removed, failed
+
+    def import_pages(self, directory, comment):
+        """ Saves the .wiki files under directory that changed since they
+            were exported with putPage in MultiCall batches. Pages changed
+            on the server since the export are skipped. Returns the lists of
+            saved, conflicting and failed pages """
+        cache = DiskCache(directory)
+        manifest = cache.load('.mirror')[0] or {'since': None, 'pages': {}}
+        known = manifest['pages']
+        files = self.mirror_pages(directory)
+        edited = sorted(name for name, data in files.iteritems()
+                        if checksum(data) != known.get(name, {}).get('checksum'))
+
+        saved, conflicts, failed = [], [], []
+        pending = []
+        calls = [('wiki.getPageInfo', (name, )) for name in edited]
+        for name, (call, info, error) in zip(edited, multicall_chunks(
+                trac.server, calls)):
+            version = known.get(name, {}).get('version')
+            if (info or {}).get('version') != version:
+                conflicts.append(name)
+            else:
+                pending.append(name)
+
+        calls = []
+        for name in pending[:]:
+            try:
+                text = files[name].decode('utf-8')
+            except UnicodeDecodeError:
+                pending.remove(name)
+                failed.append(name)
+                continue
+            calls.extend([('wiki.putPage', (name, text, {'comment': comment})),
+                          ('wiki.getPageInfo', (name, ))])
+        results = list(multicall_chunks(trac.server, calls))
+        for name, put, info in zip(pending, results[0::2], results[1::2]):
+            info = info[1]
+            if put[2] is not None or info is None:
+                failed.append(name)
+                continue
+            # since stays put, changes by others may predate this save
+            known[name] = {'version': info['version'],
+                           'checksum': checksum(files[name])}
+            saved.append(name)
+        cache.store('.mirror', manifest)
+        return saved, conflicts, failed
 
     def get_page(self, name, revision=None):
         """ Get Wiki Page """
+        name = name.strip()
         try:
-            name = name.strip()
-            self.current_page = name
-            if name not in self.visited_pages:
-                self.visited_pages.append(name)
             if revision is not None:
-                wikitext = trac.server.wiki.getPage(name, revision)
+                # revisions never change, they are kept as long as possible
+                key = ('wiki', name, revision)
+                wikitext = trac.cache.get(key)
+                if wikitext is None:
+                    wikitext = trac.server.wiki.getPage(name, revision)
+                    trac.cache.put(key, wikitext, expires=False)
             else:
                 wikitext = trac.server.wiki.getPage(name)
-                self.get_page_info()
-        except:
+        except xmlrpclib.Fault:
             if revision is None:
                 wikitext = "Describe {0} here.".format(name)
             else:
                 wikitext = ''
+        self.current_page = name
+        remember(self.visited_pages, name)
+        if revision is None:
+            self.get_page_info()
         return wikitext
 
     def save(self,  comment):
         """ Saves a Wiki Page """
         if not comment:
             comment = trac.default_comment
-        trac.server.wiki.putPage(self.current_page,
-                trac.uiwiki.wikiwindow.dump(), {"comment": comment})
+        text = trac.uiwiki.wikiwindow.dump()
+        trac.server.wiki.putPage(self.current_page, text, {"comment": comment})
+        self.note_links(self.current_page, text)
+
+    def note_links(self, name, text):
+        """ Records the pages a page links to for backlinks and prefetch """
+        links = wiki_links(text)
+        if self.pages:
+            links.intersection_update(self.pages)
+        links.discard(name)
+        self.links[name] = sorted(links)
+
+    def backlinks(self, name):
+        """ The pages known to link to name, deleted pages left out """
+        pages = set(self.pages or self.links)
+        return sorted(page for page, links in self.links.iteritems()
+                      if name in links and page in pages)
+
+    def fetch_pages(self, server, names):
+        """ Fetches pages with their attachments in one request. Safe to run
+            in the background """
+        calls = []
+        for name in names:
+            calls.extend([('wiki.getPage', (name, )),
+                          ('wiki.listAttachments', (name, ))])
+        results = [r[1] for r in multicall_chunks(server, calls, len(calls))]
+        return zip(names, results[0::2], results[1::2])
+
+    def prefetch_links(self, name):
+        """ Fetches the pages name links to in the background, wiki_view
+            shows them at once and revalidates them like a snapshot """
+        limit = int(vim.eval('g:tracWikiPrefetchLinks'))
+        names = [page for page in self.links.get(name, [])
+                 if (page, None) not in self.prefetching and
+                 ('page', page) not in trac.cache][:limit]
+        if not names:
+            return
+        self.prefetch([(page, None) for page in names], self.fetch_pages,
+                      self.store_pages, names)
+
+    def prefetch(self, keys, fetch, store, *args):
+        """ Runs fetch(proxy, *args) in the background and hands the result
+            to store. keys stay in prefetching until store ran or the fetch
+            failed, so they are not fetched twice at once """
+        self.prefetching.update(keys)
+
+        def guarded(proxy, *args):
+            try:
+                return fetch(proxy, *args)
+            except Exception:
+                trac.defer(self.prefetching.difference_update, keys)
+                raise
+        trac.revalidate(guarded, store, *args)
+
+    def store_pages(self, pages):
+        for name, text, attachments in pages:
+            self.prefetching.discard((name, None))
+            if text is not None and attachments is not None:
+                trac.cache.put(('page', name), (text, attachments,
+                                                time.time()))
+                self.note_links(name, text)
 
     def get_page_info(self):
         """ Returns page revision info most recent author """
@@ -199,30 +1564,62 @@ class TracWiki(object):
             info = trac.server.wiki.getPageInfo(self.current_page)
             self.revision = info['version']
             return '{name} v{version}, author: {author}'.format(**info)
-        except:
+        except (xmlrpclib.Error, KeyError):
             return 'Cannot get page info'
 
+    def fetch(self, server, name):
+        """ Fetches the page list and a page with its info and attachments
+            in one request. Safe to run in the background """
+        multicall = xmlrpclib.MultiCall(server)
+        multicall.wiki.getAllPages()
+        multicall.wiki.getPage(name)
+        multicall.wiki.getPageInfo(name)
+        multicall.wiki.listAttachments(name)
+        return list(multicall())
+
     def create_page(self, name, content, comment):
         """ Saves a Wiki Page """
         return trac.server.wiki.putPage(name, content, {"comment": comment})
 
     def add_attachment(self, file):
-        """ Add attachment """
+        """ Add attachment, unless the page has it already. Returns
+            whether it was uploaded """
         file_name = os.path.basename(file)
         path = '{0}/{1}'.format(self.current_page, file_name)
-        trac.server.wiki.putAttachment(path,
-                                       xmlrpclib.Binary(open(file).read()))
+        data = open(file, 'rb').read()
+        key = 'wiki:' + path
+        if path in self.attachments and trac.attachment_store.unchanged(
+                key, self.attachment_meta(path), data):
+            print '{0} is already attached'.format(file_name)
+            return False
+        trac.server.wiki.putAttachment(path, xmlrpclib.Binary(data))
+        meta = self.attachment_meta(path)
+        if meta:
+            trac.attachment_store.add(key, meta, data)
+        return True
+
+    def attachment_meta(self, path):
+        """ [size, time] of an attachment from its raw-attachment headers,
+            xmlrpc does not list them for wiki attachments """
+        try:
+            info = trac.session.open('/raw-attachment/wiki/' +
+                                     url_quote(path),
+                                     method='HEAD').info()
+            return [int(info['Content-Length']), info['Last-Modified']]
+        except (urllib2.URLError, httplib.HTTPException, socket.error,
+                KeyError, ValueError):
+            return None
 
     def get_attachment(self, file):
-        """ Get attachment """
-        buffer = trac.server.wiki.getAttachment(file)
+        """ Get attachment, from the attachment store when it holds the
+            version on the server """
         file_name = os.path.basename(file)
-
-        if os.path.exists(file_name):
-            print "Will not overwrite existing file {0}".format(file_name)
-        else:
-            with open(file_name, 'w') as fp:
-                fp.write(buffer.data)
+        key = 'wiki:' + file
+        meta = self.attachment_meta(file)
+        copy, data = trac.attachment_store.get(
+                trac.session, key, '/raw-attachment/wiki/' + url_quote(file),
+                meta, lambda: trac.server.wiki.getAttachment(file).data)
+        save_attachment(file_name, data, copy)
 
     def list_attachments(self):
         """ Look for attachments on the current page """
@@ -230,7 +1627,12 @@ class TracWiki(object):
 
     def get_wiki_html(self, wikitext):
         """ Converts the wikitext from a buffer to html for previews """
-        return trac.server.wiki.wikiToHtml(wikitext)
+        key = ('html', checksum(wikitext))
+        html = trac.cache.get(key)
+        if html is None:
+            html = trac.server.wiki.wikiToHtml(wikitext)
+            trac.cache.put(key, html)
+        return html
 
     def html_view(self, page=None):
         """ Displays a wiki in a preview browser as set in trac.vim """
@@ -245,28 +1647,99 @@ class TracWiki(object):
         browser = vim.eval('g:tracBrowser')
         vim.command('!{0} file://{1}'.format(browser, file_name))
 
-    def get_options(self):
-        """ returns a list of a sites wiki pages for command completes """
-        vim.command('let g:tracOptions="{0}"'.format("|".join(self.pages)))
+    def load_history(self):
+        """ Fetches the info of every revision of the current page, newest
+            first. Only revisions not seen before are requested """
+        name = self.current_page
+        calls = [('wiki.getPageInfo', (name, version))
+                 for version in xrange(1, self.revision + 1)
+                 if ('wikiinfo', name, version) not in trac.cache]
+        for (method, args), info, error in multicall_chunks(trac.server,
+                                                             calls):
+            if not error:
+                trac.cache.put(('wikiinfo', ) + args, info, expires=False)
+        self.history = []
+        for version in xrange(self.revision, 0, -1):
+            info = trac.cache.get(('wikiinfo', name, version))
+            if info:
+                self.history.append(info)
+
+    def render_history(self):
+        """ Lists the revisions, the one in the diff split is marked """
+        lines = ['= History of {0} ='.format(self.current_page), '']
+        for info in self.history:
+            lines.append('{0} v{1:<4} {2}  {3}: {4}'.format(
+                '>' if info['version'] == self.diff_revision else ' ',
+                info['version'],
+                to_datetime(info['lastModified']).strftime(
+                    '%a %d/%m/%Y %H:%M'),
+                info['author'], ' '.join(info.get('comment', '').split())))
+        return '\n'.join(lines)
+
+    def fetch_revisions(self, server, name, revisions):
+        """ Fetches revisions of a page in one request. Safe to run in the
+            background """
+        calls = [('wiki.getPage', (name, revision)) for revision in revisions]
+        return [(args, wikitext, error) for (method, args), wikitext, error
+                in multicall_chunks(server, calls, len(calls))]
+
+    def prefetch_revisions(self, revision):
+        """ Fetches the revisions around revision in the background so
+            stepping through the history does not wait for the server """
+        name = self.current_page
+        revisions = [r for r in xrange(revision - self.prefetch_depth,
+                                       revision + self.prefetch_depth + 1)
+                     if 0 < r < self.revision and
+                     (name, r) not in self.prefetching and
+                     ('wiki', name, r) not in trac.cache]
+        if not revisions:
+            return
+        self.prefetch([(name, r) for r in revisions], self.fetch_revisions,
+                      self.store_revisions, name, revisions)
+
+    def store_revisions(self, revisions):
+        for args, wikitext, error in revisions:
+            self.prefetching.discard(args)
+            if not error:
+                trac.cache.put(('wiki', ) + args, wikitext, expires=False)
 
     def vim_diff(self, revision=None):
-        """ Creates a vimdiff of an earlier wiki revision """
+        """ Shows an earlier wiki revision in a diff split next to the
+            page """
         #default to previous revision
         if revision is None:
             revision = self.revision - 1
+        revision = int(revision)
 
         wikitext = self.get_page(self.current_page, revision)
         if not wikitext:
             print 'No previous version available'
             return
-
-        diffwindow = WikiVimDiffWindow()
-        diffwindow.create('vertical belowright diffsplit')
+        self.diff_revision = revision
+
+        diffwindow = trac.uiwiki.diffwindow
+        if diffwindow.get_winnr() < 0:
+            trac.uiwiki.wikiwindow.set_focus()
+            diffwindow.create('vertical belowright diffsplit')
+            trac.uiwiki.tocwindow.resize_width(30)
+            diffwindow.resize_width(80)
+        winnr = vim.eval('winnr()')
         diffwindow.write(wikitext)
-
-        trac.uiwiki.tocwindow.resize_width(30)
-        trac.uiwiki.wikiwindow.set_focus()
-        diffwindow.resize_width(80)
+        if trac.uiwiki.historywindow.get_winnr() > 0:
+            trac.uiwiki.historywindow.write(self.render_history())
+        vim.command('{0}wincmd w'.format(winnr))
+        self.prefetch_revisions(revision)
+        print 'Revision {0} of {1}'.format(revision, self.revision)
+
+    def step_diff(self, step):
+        """ Moves the diff split to an older (-1) or newer (1) revision """
+        if self.diff_revision is None:
+            return self.vim_diff()
+        revision = self.diff_revision + step
+        if not 0 < revision < self.revision:
+            print 'Error: History out of range'
+            return
+        self.vim_diff(revision)
 
 
 class TracWikiUI(UI):
@@ -276,12 +1749,18 @@ class TracWikiUI(UI):
         self.wikiwindow = WikiWindow()
         self.tocwindow = WikiTOContentsWindow()
         self.attachwindow = AttachmentWindow()
+        self.diffwindow = WikiVimDiffWindow()
+        self.historywindow = WikiHistoryWindow()
+        self.backlinkswindow = WikiBacklinksWindow()
 
     def destroy(self):
         """ destroy windows """
         self.wikiwindow.destroy()
         self.tocwindow.destroy()
         self.attachwindow.destroy()
+        self.diffwindow.destroy()
+        self.historywindow.destroy()
+        self.backlinkswindow.destroy()
 
         vim.command("call UnloadWikiCommands()")
 
@@ -333,16 +1812,12 @@ class WikiTOContentsWindow(NonEditableWindow):
     def __init__(self, name='WIKITOC_WINDOW'):
         NonEditableWindow.__init__(self, name)
 
-        if vim.eval('tracHideTracWiki') == 'yes':
-            self.hide_trac_wiki = True
-        else:
-            self.hide_trac_wiki = False
-
     def on_create(self):
         nmaps = [
-            ('<cr>', ':python trac.wiki_view("CURRENTLINE")<cr>'),
-            ('<2-LeftMouse>', ':python trac.wiki_view("CURRENTLINE")<cr>'),
-            ('<Space>', ':python trac.wiki.html_view()<cr><cr><cr>'),
+            ('<cr>', ':python trac.wiki_toc_select()<cr>'),
+            ('<2-LeftMouse>', ':python trac.wiki_toc_select()<cr>'),
+            ('o', ':python trac.wiki_toc_toggle()<cr>'),
+            ('<Space>', ':python trac.wiki_toc_preview()<cr>'),
         ]
         for m in nmaps:
             vim.command('nnoremap <buffer> {0} {1}'.format(*m))
@@ -351,22 +1826,7 @@ class WikiTOContentsWindow(NonEditableWindow):
         vim.command('setlocal cursorline')
         vim.command('setlocal linebreak')
         vim.command('setlocal noswapfile')
-
-    def on_write(self):
-        if self.hide_trac_wiki:
-            vim.command('silent g/^Trac/d _')
-            vim.command('silent g/^Wiki/d _')
-            vim.command('silent g/^InterMapTxt$/d _')
-            vim.command('silent g/^InterWiki$/d _')
-            vim.command('silent g/^SandBox$/d _')
-            vim.command('silent g/^InterTrac$/d _')
-            vim.command('silent g/^TitleIndex$/d _')
-            vim.command('silent g/^RecentChanges$/d _')
-            vim.command('silent g/^CamelCase$/d _')
-
-        vim.command('sort')
-        vim.command('silent norm ggOWikiStart')
-        NonEditableWindow.on_write(self)
+        vim.command('setlocal nowrap')
 
 
 class AttachmentWindow(NonEditableWindow):
@@ -390,6 +1850,8 @@ class WikiVimDiffWindow(NonEditableWindow):
     def on_create(self):
         vim.command('nnoremap <buffer> <c-]> '
                     ':python trac.wiki_view("<C-R><C-W>")<cr>')
+        vim.command('nnoremap <buffer> wb :python trac.wiki_diff(step=-1)<cr>')
+        vim.command('nnoremap <buffer> wf :python trac.wiki_diff(step=1)<cr>')
         vim.command('nnoremap <buffer> :q!<cr> '
                     ':python trac.uiwiki.tocwindow.resize_width(30)<cr>')
         #map gf to a new buffer(switching buffers doesnt work with nofile)
@@ -399,26 +1861,108 @@ class WikiVimDiffWindow(NonEditableWindow):
         vim.command('setlocal linebreak')
         vim.command('setlocal noswapfile')
 
+    def on_write(self):
+        NonEditableWindow.on_write(self)
+        vim.command('diffupdate')
+
+
+class WikiHistoryWindow(NonEditableWindow):
+    """ Revisions of the current wiki page """
+    def __init__(self, name='WIKIHISTORY_WINDOW'):
+        NonEditableWindow.__init__(self, name)
+
+    def on_create(self):
+        nmaps = [
+            ('<cr>', ':python trac.wiki_history_select()<cr>'),
+            ('<2-LeftMouse>', ':python trac.wiki_history_select()<cr>'),
+            ('wb', ':python trac.wiki_diff(step=-1)<cr>'),
+            ('wf', ':python trac.wiki_diff(step=1)<cr>'),
+        ]
+        for m in nmaps:
+            vim.command('nnoremap <buffer> {0} {1}'.format(*m))
+        vim.command('setlocal cursorline')
+        vim.command('setlocal noswapfile')
+        vim.command('setlocal nowrap')
+
+
+class WikiBacklinksWindow(NonEditableWindow):
+    """ Pages linking to the current wiki page """
+    def __init__(self, name='WIKIBACKLINKS_WINDOW'):
+        NonEditableWindow.__init__(self, name)
+
+    def on_create(self):
+        vim.command('nnoremap <buffer> <cr> '
+                    ':python trac.wiki_view("CURRENTLINE")<cr>')
+        vim.command('nnoremap <buffer> <2-LeftMouse> '
+                    ':python trac.wiki_view("CURRENTLINE")<cr>')
+        vim.command('setlocal cursorline')
+        vim.command('setlocal noswapfile')
+
 
 class TracSearch(object):
     """ Search for tickets and Wiki's """
+    more_line = '-- {0} more results (hit <enter> here for more) --'
+
+    def __init__(self):
+        self.reset_attrs()
+
+    def reset_attrs(self):
+        self.filters = []
+        self.pattern = ''
+        self.realms = []
+        self.results = []
+        self.shown = 0
+
+    def get_filters(self):
+        """ Names of the realms the server searches """
+        if not self.filters:
+            self.filters = [f[0] for f in
+                            trac.server.search.getSearchFilters()]
+        return self.filters
+
     def search(self, search_pattern):
-        """ Perform a search call  """
-        a_search = trac.server.search.performSearch(search_pattern)
+        """ Perform a search call. Leading realm names (ticket, wiki...) limit
+            the search to those realms """
+        words = search_pattern.split()
+        realms = []
+        while len(words) > 1 and words[0] in self.get_filters():
+            realms.append(words.pop(0))
+        self.pattern = ' '.join(words)
+        self.realms = realms
+        if realms:
+            self.results = trac.server.search.performSearch(self.pattern,
+                                                            realms)
+        else:
+            self.results = trac.server.search.performSearch(self.pattern)
+        self.shown = int(vim.eval('g:tracSearchPageSize'))
+        return self.render()
+
+    def more(self):
+        """ Renders another page of results """
+        self.shown += int(vim.eval('g:tracSearchPageSize'))
+        return self.render()
+
+    def render(self):
+        """ Formats the results up to the shown page """
         result = [
-            "Results for {0}".format(search_pattern),
+            "Results for {0}{1}".format(self.pattern, ' in {0}'.format(
+                ', '.join(self.realms)) if self.realms else ''),
             "(Hit <enter> or <space> on a line containing :>>)",
             "",
         ]
-        for search in a_search:
-            if '/ticket/' in search[0]:
-                prefix = "Ticket"
-            if '/wiki/' in search[0]:
-                prefix = "Wiki"
-            if '/changeset/' in search[0]:
-                prefix = "Changeset"
-            title = '{0}:>> {1}'.format(prefix, os.path.basename(search[0]))
+        for search in self.results[:self.shown]:
+            m = (re.search(r'/(ticket|wiki|changeset)/(.*)$', search[0]) or
+                 re.search(r'([^/]+)/([^/]*)$', search[0]))
+            if m:
+                realm, name = m.groups()
+                title = '{0}:>> {1}'.format(realm.title(), name)
+            else:
+                # nothing to open, show the url as the server sent it
+                title = search[0]
             result.extend([title, search[4], ""])
+        hidden = len(self.results) - self.shown
+        if hidden > 0:
+            result.append(self.more_line.format(hidden))
         return '\n'.join(result)
 
 
@@ -471,23 +2015,55 @@ class TracSearchWindow(NonEditableWindow):
 
 class TracTicket(object):
     """ Trac Ticket Class """
+    # in the order get_attribs fetches them
+    attrib_names = ['milestone', 'type', 'status', 'resolution', 'priority',
+                    'severity', 'component', 'version']
+    # tickets per page when a query has no max, trac's default items_per_page
+    page_size = 100
+    list_columns = ['#', 'summary', 'status', 'type', 'priority', 'component',
+                    'milestone', 'version', 'owner', 'reporter']
+    # connection failures after which a request surely was not sent
+    unsent_errors = (errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                     errno.ENETUNREACH)
+
     def __init__(self):
         self.reset_attrs()
 
     def reset_attrs(self):
         self.current_ticket_id = None
+        self.current_ticket = None
+        self.current_actions = []
         self.visited_tickets = []
+        self.watched = []
         self.actions = []
         self.attribs = []
+        self.fields = []
         self.tickets = []
+        self.fetched = None
         self.sorter = {'order': 'priority', 'group': 'milestone'}
         self.filters = {}
         self.page = 1
         self.attachments = []
+        self.attachment_info = {}
+        self.changelog = []
+        self.changelog_shown = 0
 
     def get_attribs(self):
-        """ Get all milestone/ priority /status options """
-        multicall = xmlrpclib.MultiCall(trac.server)
+        """ Get all milestone/ priority /status options. They are read from
+            the disk cache and revalidated in the background once stale """
+        cached, age = trac.disk_cache.load('attribs')
+        if cached is None:
+            self.fetch_attribs(trac.server, trac.disk_cache)
+            return
+
+        self.attribs, self.fields = cached['attribs'], cached['fields']
+        if age > int(vim.eval('g:tracMetadataTTL')):
+            run_in_background(self.fetch_attribs, trac.make_server_proxy(),
+                              trac.disk_cache)
+
+    def fetch_attribs(self, server, disk_cache):
+        """ Fetches the ticket options and fields and caches them on disk """
+        multicall = xmlrpclib.MultiCall(server)
         multicall.ticket.milestone.getAll()
         multicall.ticket.type.getAll()
         multicall.ticket.status.getAll()
@@ -496,53 +2072,184 @@ class TracTicket(object):
         multicall.ticket.severity.getAll()
         multicall.ticket.component.getAll()
         multicall.ticket.version.getAll()
-        self.attribs = [option for option in multicall()]
+        multicall.ticket.getTicketFields()
+        result = [option for option in multicall()]
+        attribs, fields = result[:-1], result[-1]
+        disk_cache.store('attribs', {'attribs': attribs, 'fields': fields})
+        # the server may have been switched while this ran in the background
+        if disk_cache is trac.disk_cache:
+            self.attribs, self.fields = attribs, fields
 
     def set_sort_attr(self, attrib, value):
         self.sorter[attrib] = value
 
-    def query_string(self, f_all=False):
+    def query_string(self, f_all=False, url=False):
+        """ The query of the list. With url set the filter values are quoted
+            for a web /query url, where a value may hold spaces, &, # or
+            non-ascii text """
         query = 'order={order}&group={group}&page={page}'
         query = query.format(page=self.page, **self.sorter)
         query = '{0}&{1}'.format(query, vim.eval('g:tracTicketClause'))
-        filters = ['{0}={1}'.format(k, v) for k, v in self.filters.iteritems()]
+        filters = ['{0}={1}'.format(k, url_quote(v.replace('\\&', '&'))
+                                    if url else v)
+                   for k, v in self.filters.iteritems()]
         if filters:
             query = '{0}&{1}'.format(query, '&'.join(filters))
         if f_all:
             query = '{0}&max=0'.format(query)
         return query
 
+    def query_csv(self, query, columns):
+        """ Fetches only the given columns of a query from trac's csv export
+            in one streamed request. Rows are shaped like ticket.get results
+            with just those fields """
+        if not re.search(r'(^|&)max=', query):
+            query = '{0}&max={1}'.format(query, self.page_size)
+        path = '/query?format=csv&{0}&{1}'.format(
+                '&'.join(['col={0}'.format(c) for c in columns[1:]]), query)
+        reader = csv.reader(trac.session.open(path))
+        header = [xmlrpc_strings(h.decode('utf-8-sig')) for h in reader.next()]
+        tickets = []
+        for row in reader:
+            fields = dict(zip(header, [xmlrpc_strings(v.decode('utf-8'))
+                                       for v in row]))
+            tickets.append([int(fields['id']), None, None, fields])
+        return tickets
+
     def number_tickets(self):
+        if self.fetched:
+            return len(self.tickets)
         return len(trac.server.ticket.query(self.query_string(True)))
 
-    def get_all(self, summary=True, cached=False):
-        """ Gets a List of Ticket Pages """
+    def page_limit(self):
+        """ Tickets per page of the query, a max= in g:tracTicketClause
+            included. None when the query is not paged (max=0) """
+        limits = re.findall(r'(?:^|&)max=(\d+)', self.query_string())
+        if not limits:
+            return self.page_size
+        return int(limits[-1]) or None
+
+    def set_rows(self, tickets):
+        """ Keeps a fetched page of tickets for the list. A first page
+            shorter than the page limit is the whole result set, it is also
+            kept with the settings it was fetched with for arrange """
+        self.tickets = self.list_rows(tickets)
+        self.fetched = None
+        limit = self.page_limit()
+        if self.page == 1 and (limit is None or len(self.tickets) < limit):
+            self.fetched = (dict(self.filters), dict(self.sorter),
+                            self.tickets)
+        return self.tickets
+
+    def arrange(self):
+        """ Filters and sorts the kept result set for the current settings
+            without asking the server. Returns False when it cannot, that is
+            when a filter was loosened or is not a plain (!)value match, or
+            a field is missing from the kept tickets """
+        if not self.fetched or self.page != 1:
+            return False
+        filters, sorter, tickets = self.fetched
+        if any(self.filters.get(k) != v for k, v in filters.iteritems()):
+            return False
+        narrowed = [(k, v) for k, v in self.filters.iteritems()
+                    if k not in filters]
+        fields = [k for k, v in narrowed]
+        if sorter != self.sorter:
+            fields.extend(f for f in (self.sorter['group'],
+                                      self.sorter['order']) if f != 'id')
+        if any(re.match(r'!?[~^$]', v) or '\\' in v for k, v in narrowed):
+            return False
+        if any(f not in t[3] for t in tickets for f in fields if f):
+            return False
+
+        for k, v in narrowed:
+            values = to_unicode(v).lstrip('!').split('|')
+            tickets = [t for t in tickets if
+                       (t[3][k] in values) != v.startswith('!')]
+        if sorter != self.sorter:
+            tickets = sorted(tickets, key=lambda t: t[0])
+            for f in (self.sorter['order'], self.sorter['group']):
+                if f:
+                    tickets.sort(key=self.sort_key(f))
+        self.tickets = tickets
+        return True
+
+    def sort_key(self, field):
+        """ Sorts like trac, fields with options in their defined order """
+        if field == 'id':
+            return lambda ticket: ticket[0]
+        options = {}
+        if field in self.attrib_names and self.attribs:
+            options = dict((option, i) for i, option in enumerate(
+                           self.attribs[self.attrib_names.index(field)]))
+        return lambda ticket: (ticket[3][field] not in options,
+                               options.get(ticket[3][field]), ticket[3][field])
+
+    def get_all(self, summary=True, cached=False, progress=None):
+        """ Gets a List of Ticket Pages. Over xmlrpc the tickets are fetched
+            in batches of g:tracBatchSize and progress, when given, is
+            called with the rendered lines of each batch as it arrives """
         if not self.attribs:
             self.get_attribs()
 
-        if cached and self.tickets:
+        # a kept result set may have been filtered down to no tickets
+        if cached and (self.tickets or self.fetched):
             tickets = self.tickets
         else:
-            multicall = xmlrpclib.MultiCall(trac.server)
-            for ticket in trac.server.ticket.query(self.query_string()):
-                multicall.ticket.get(ticket)
-            tickets = multicall()
-            self.tickets = tickets
-
-        columns = ['#', 'summary', 'status', 'type', 'priority', 'component',
-                   'milestone', 'version', 'owner', 'reporter']
-        if summary:
-            ticket_list = [' || '.join([c.title() for c in columns])]
-        else:
-            ticket_list = ["Hit <enter> or <space> on a line containing :>>"]
-            arranged = 'Group: {group}, Order: {order}, Page: {page}'
-            ticket_list.append(arranged.format(page=self.page, **self.sorter))
-            filters = ', '.join(['{0}={1}'.format(k, v) for k, v
-                                    in self.filters.iteritems()])
-            ticket_list.append('Filters: {0}'.format(filters))
-            ticket_list.append('No. of tickets: {0}'.format(
-                                self.number_tickets()))
+            tickets = None
+            if trac.list_fetch == 'csv':
+                try:
+                    tickets = self.query_csv(self.query_string(url=True),
+                                             ['id'] + self.list_columns[1:])
+                except (urllib2.URLError, httplib.HTTPException, socket.error,
+                        csv.Error, ValueError, KeyError), e:
+                    print 'CSV query failed ({0}), using xmlrpc'.format(e)
+                    trac.list_fetch = 'rpc'
+            if tickets is None:
+                tickets = self.fetch_rows(summary, progress)
+            tickets = self.set_rows(tickets)
+        ticket_list = self.list_header(summary, self.number_tickets())
+        ticket_list.extend(self.list_lines(tickets, summary))
+        return "\n".join(ticket_list)
 
+    def fetch_rows(self, summary, progress=None):
+        """ Gets the tickets of the query page one MultiCall batch at a
+            time, handing each batch to progress once decoded """
+        calls = [('ticket.get', (tid, )) for tid
+                 in trac.server.ticket.query(self.query_string())]
+        size = batch_size()
+        tickets = []
+        if progress:
+            progress(self.list_header(summary), 0, len(calls))
+        for call, ticket, error in multicall_chunks(trac.server, calls, size):
+            if error:
+                raise error
+            tickets.append(ticket)
+            if progress and (len(tickets) % size == 0 or
+                             len(tickets) == len(calls)):
+                start = (len(tickets) - 1) // size * size
+                progress(self.list_lines(tickets[start:], summary),
+                         len(tickets), len(calls))
+        return tickets
+
+    def list_header(self, summary, count=None):
+        """ The lines above the tickets, the count is left out while the
+            list is still being fetched """
+        if summary:
+            return [' || '.join([c.title() for c in self.list_columns])]
+        ticket_list = ["Hit <enter> or <space> on a line containing :>>"]
+        arranged = 'Group: {group}, Order: {order}, Page: {page}'
+        ticket_list.append(arranged.format(page=self.page, **self.sorter))
+        filters = u', '.join([u'{0}={1}'.format(k, to_unicode(v)) for k, v
+                              in self.filters.iteritems()])
+        ticket_list.append(u'Filters: {0}'.format(filters))
+        if count is not None:
+            ticket_list.append('No. of tickets: {0}'.format(count))
+        return ticket_list
+
+    def list_lines(self, tickets, summary):
+        """ Renders tickets as rows of the summary or as toc entries """
+        ticket_list = []
         for ticket in tickets:
             if summary:
                 str_ticket = [str(ticket[0]),
@@ -550,32 +2257,113 @@ class TracTicket(object):
             else:
                 str_ticket = ["", "Ticket:>> {0}".format(ticket[0]),
                               ticket[3]['summary']]
-            for f in columns[2:]:
+            for f in self.list_columns[2:]:
                 v = truncate_words(ticket[3].get(f, ''))
                 if not summary:
-                    v = "   * {0}: {1}".format(f.title(), v)
+                    v = u"   * {0}: {1}".format(f.title(), v)
                 str_ticket.append(v)
 
             separator = ' || ' if summary else '\n'
             ticket_list.append(separator.join(str_ticket))
+        return ticket_list
 
-        return "\n".join(ticket_list)
+    def list_rows(self, tickets):
+        """ Drops the descriptions of a page of tickets kept for the list """
+        return [ticket[:3] + [dict((k, v) for k, v in ticket[3].iteritems()
+                                   if k != 'description')]
+                for ticket in tickets]
 
     def get(self, tid):
         """ Get Ticket Page """
         try:
             tid = int(tid)
             ticket = trac.server.ticket.get(tid)
-            self.current_ticket_id = tid
-            if tid not in self.visited_tickets:
-                self.visited_tickets.append(tid)
-            ticket_changelog = trac.server.ticket.changeLog(tid)
-            self.current_component = ticket[3].get("component")
-            actions = self.get_actions()
-            self.list_attachments()
-        except:
+            self.load(ticket, None, trac.server.ticket.getActions(tid),
+                      trac.server.ticket.listAttachments(tid))
+        except (xmlrpclib.Fault, ValueError, TypeError):
             return 'Please select a ticket'
 
+        return self.render()
+
+    def fetch(self, server, tid, query):
+        """ Fetches a ticket with everything load needs and the tickets of a
+            query in two requests. Safe to run in the background """
+        multicall = xmlrpclib.MultiCall(server)
+        multicall.ticket.get(tid)
+        multicall.ticket.changeLog(tid)
+        multicall.ticket.getActions(tid)
+        multicall.ticket.listAttachments(tid)
+        multicall.ticket.query(query)
+        result = list(multicall())
+        multicall = xmlrpclib.MultiCall(server)
+        for t in result.pop():
+            multicall.ticket.get(t)
+        return result, list(multicall())
+
+    def load(self, ticket, changelog, actions, attachments):
+        """ Makes a fetched ticket the current one. When changelog is None
+            the cached rendering is used unless the ticket changed since """
+        tid = ticket[0]
+        cached = trac.cache.get(('changelog', tid))
+        if changelog is None and (cached is None or
+                                  cached[0] != str(ticket[2])):
+            changelog = trac.server.ticket.changeLog(tid)
+        if tid != self.current_ticket_id:
+            self.changelog_shown = int(vim.eval('g:tracTicketChangelogLimit'))
+        self.current_ticket_id = tid
+        remember(self.visited_tickets, tid)
+        if changelog is None:
+            self.changelog = cached[1]
+        else:
+            self.changelog = self.changelog_groups(changelog)
+        trac.cache.put(('changelog', tid), (str(ticket[2]), self.changelog))
+        self.current_component = ticket[3].get("component")
+        self.current_ticket = ticket
+        self.current_actions = self.set_actions(actions)
+        self.set_attachments(attachments)
+
+    def changelog_groups(self, ticket_changelog):
+        """ Splits a changelog into one group per submission, the changes one
+            author saved within a minute. Groups are [changes, text], the
+            text is formatted by changelog_text once the group is shown """
+        groups = []
+        submission = None
+        for change in ticket_changelog:
+            if not change[4]:
+                continue
+            new_submission = (str(change[0])[:14], change[1])
+            if submission != new_submission:
+                groups.append([[], None])
+                submission = new_submission
+            groups[-1][0].append(change)
+        return groups
+
+    def changelog_text(self, group):
+        """ Formats a submission, the text is kept in the group """
+        if group[1] is not None:
+            return group[1]
+        changes = group[0]
+        my_time = to_datetime(changes[0][0]).strftime("%a %d/%m/%Y %H:%M")
+        lines = ["", '== {0} ({1}) =='.format(my_time, changes[0][1])]
+        for change in changes:
+            if change[2] in ('comment', 'description'):
+                lines.append(' * {0}:'.format(change[2]))
+                lines.append(change[4])
+            else:
+                if change[3]:
+                    lines.append(" * '''{0}''': ''{1}'' > ''{2}''".format(
+                        change[2], change[3], change[4]))
+                else:
+                    lines.append(" * '''{0}''': ''{1}''".format(change[2],
+                        change[4]))
+            # TODO: just mention if a ticket has been changed
+            # brief = vim.eval('g:tracTicketBriefDescription')
+        group[1] = '\n'.join(lines)
+        return group[1]
+
+    def render(self):
+        """ Formats the current ticket with its most recent changes """
+        ticket = self.current_ticket
         str_ticket = ["= Ticket Summary =", "",
                 "Ticket #{0}: {1}".format(ticket[0], ticket[3]['summary']), ""]
         for f in ('owner', 'reporter', 'status', 'type', 'priority',
@@ -590,44 +2378,27 @@ class TracTicket(object):
         str_ticket.append("")
         str_ticket.append("= Changelog =")
 
-        submission = [None, None]
-        for change in ticket_changelog:
-            if not change[4]:
-                continue
-            if isinstance(change[0], xmlrpclib.DateTime):
-                dt = datetime.datetime.strptime(change[0].value,
-                                                "%Y%m%dT%H:%M:%S")
-            else:
-                dt = datetime.datetime.fromtimestamp(change[0])
-
-            my_time = dt.strftime("%a %d/%m/%Y %H:%M")
-            new_submission = [my_time, change[1]]
-            if submission != new_submission:
-                str_ticket.append("")
-                str_ticket.append('== {0} ({1}) =='.format(my_time,
-                                                            change[1]))
-                submission = new_submission
-            if change[2] in ('comment', 'description'):
-                str_ticket.append(' * {0}:'.format(change[2]))
-                str_ticket.append(change[4])
-            else:
-                if change[3]:
-                    str_ticket.append(" * '''{0}''': ''{1}'' > ''{2}''".format(
-                        change[2], change[3], change[4]))
-                else:
-                    str_ticket.append(" * '''{0}''': ''{1}''".format(change[2],
-                        change[4]))
-            # TODO: just mention if a ticket has been changed
-            # brief = vim.eval('g:tracTicketBriefDescription')
+        groups = self.changelog
+        hidden = max(len(groups) - self.changelog_shown, 0)
+        if hidden:
+            str_ticket.append("")
+            str_ticket.append("== {0} older updates hidden (wh shows more) "
+                              "==".format(hidden))
+        str_ticket.extend(self.changelog_text(g) for g in groups[hidden:])
 
         str_ticket.append("")
         str_ticket.append('== Action ==')
         str_ticket.append("")
-        for action in actions:
+        for action in self.current_actions:
             str_ticket.append(' - {action[0]}'.format(action=action))
 
         return '\n'.join(str_ticket)
 
+    def more_history(self):
+        """ Renders another page of older changes """
+        self.changelog_shown += int(vim.eval('g:tracTicketChangelogLimit'))
+        return self.render()
+
     def update(self, comment, attribs={}, notify=False):
         """ add ticket comments change attributes """
         return trac.server.ticket.update(self.current_ticket_id, comment,
@@ -638,32 +2409,139 @@ class TracTicket(object):
         self.current_ticket_id = trac.server.ticket.create(summary,
                 description, attributes, False)
 
-    def get_attachment(self, file):
-        """ Get attachment """
-        buffer = trac.server.ticket.getAttachment(self.current_ticket_id, file)
-        file_name = os.path.basename(file)
+    def parse_import(self, text):
+        """ Splits a bulk import buffer into [header, description] blocks,
+            the header being a list of [field, value] pairs """
+        known = set(self.options('field') + ['summary', 'id', 'error'])
+        blocks = []
+        for chunk in re.split(r'(?m)^={4,}[ \t]*$', text):
+            lines = chunk.strip('\n').split('\n')
+            header = []
+            while lines:
+                # a description line like "Note: ..." is not a field
+                m = re.match(r'^(\w+):', lines[0])
+                if not m or m.group(1) not in known:
+                    break
+                field, value = lines.pop(0).split(':', 1)
+                header.append([field.strip(), value.strip()])
+            if lines and not lines[0].strip():
+                lines.pop(0)
+            if header or any(lines):
+                blocks.append([header, '\n'.join(lines)])
+        return blocks
+
+    def format_import(self, blocks):
+        """ Reverse of parse_import """
+        str_blocks = []
+        for header, description in blocks:
+            lines = ['{0}: {1}'.format(*h) for h in header]
+            if description:
+                lines.extend(['', description])
+            str_blocks.append('\n'.join(lines))
+        return '\n====\n'.join(str_blocks)
+
+    def bulk_create(self, blocks):
+        """ Creates a ticket for each block without an id. Blocks whose
+            batch never reached the server are retried once. A fault would
+            only repeat and after any other failure the tickets may exist
+            already. The new ids or errors are recorded in the headers.
+            Returns the number of created tickets """
+        def set_field(header, field, value):
+            header[:] = [h for h in header if h[0] not in ('id', 'error')]
+            header.insert(0, [field, value])
+
+        pending = []
+        for block in blocks:
+            fields = dict(block[0])
+            if fields.get('id'):
+                continue
+            if not fields.get('summary'):
+                set_field(block[0], 'error', 'no summary')
+                continue
+            pending.append(block)
+
+        created = 0
+        for retry in (False, True):
+            calls = []
+            for header, description in pending:
+                attribs = dict((k, v) for k, v in header
+                               if k not in ('summary', 'id', 'error'))
+                calls.append(('ticket.create', (dict(header)['summary'],
+                                                description, attribs, False)))
+            failed = []
+            results = multicall_chunks(trac.server, calls)
+            for block, (call, tid, error) in zip(pending, results):
+                if error is None:
+                    set_field(block[0], 'id', str(tid))
+                    created += 1
+                else:
+                    message = getattr(error, 'faultString', None) or str(error)
+                    if isinstance(message, unicode):
+                        message = message.encode('utf-8')
+                    # one line, or the next parse_import reads it wrong
+                    set_field(block[0], 'error', ' '.join(message.split()))
+                    if getattr(error, 'errno', None) in self.unsent_errors:
+                        failed.append(block)
+            pending = failed
+            if not pending:
+                break
+        return created
 
-        if os.path.exists(file_name):
-            print "Will not overwrite existing file", file_name
-        else:
-            with open(file_name, 'w') as fp:
-                fp.write(buffer.data)
+    def get_attachment(self, file):
+        """ Get attachment, from the attachment store when it holds the
+            version on the server """
+        tid = self.current_ticket_id
+        key = 'ticket:{0}/{1}'.format(tid, file)
+        meta = self.attachment_meta(file)
+        copy, data = trac.attachment_store.get(
+                trac.session, key, '/raw-attachment/ticket/{0}/{1}'.format(
+                tid, url_quote(file)), meta,
+                lambda: trac.server.ticket.getAttachment(tid, file).data)
+        save_attachment(os.path.basename(file), data, copy)
+
+    def attachment_meta(self, file_name, fresh=False):
+        """ [size, time] of an attachment, from the listing loaded with the
+            ticket unless fresh """
+        if fresh or (file_name in self.attachments and
+                     file_name not in self.attachment_info):
+            self.list_attachments()
+        return self.attachment_info.get(file_name)
 
     def add_attachment(self, file, comment=''):
-        """ Add attachment """
+        """ Add attachment, unless the ticket has it already and there is no
+            comment to post. Returns whether it was uploaded """
         file_name = os.path.basename(file)
+        data = open(file, 'rb').read()
+        key = 'ticket:{0}/{1}'.format(self.current_ticket_id, file_name)
+        if not comment.strip() and trac.attachment_store.unchanged(
+                key, self.attachment_meta(file_name), data):
+            print '{0} is already attached'.format(file_name)
+            return False
         trac.server.ticket.putAttachment(self.current_ticket_id, file_name,
-                comment, xmlrpclib.Binary(open(file).read()))
+                comment, xmlrpclib.Binary(data))
+        meta = self.attachment_meta(file_name, True)
+        if meta:
+            trac.attachment_store.add(key, meta, data)
+        return True
 
     def list_attachments(self):
-        a_attach = trac.server.ticket.listAttachments(self.current_ticket_id)
+        self.set_attachments(trac.server.ticket.listAttachments(
+                             self.current_ticket_id))
+
+    def set_attachments(self, a_attach):
         self.attachments = []
+        self.attachment_info = {}
         for attach in a_attach:
             self.attachments.append(attach[0])
+            self.attachment_info[attach[0]] = [attach[2], str(attach[3])]
 
     def get_actions(self):
         """ Get available actions for a ticket """
-        actions = trac.server.ticket.getActions(self.current_ticket_id)
+        return self.set_actions(trac.server.ticket.getActions(
+                                self.current_ticket_id))
+
+    def set_actions(self, actions):
+        """ Flattens getActions output into completion options """
         self.actions = []
         for action in actions:
             if action[3]:
@@ -678,43 +2556,178 @@ class TracTicket(object):
                 self.actions.append(action[0])
         return actions
 
-    def act(self, action, comment=''):
-        """ Perform an action on current ticket """
+    def action_attribs(self, action, actions):
+        """ Validates an action string against the result of getActions and
+            returns the attributes for ticket.update """
         action = action.split()
         try:
             name, options = action[0], action[1:]
         except IndexError:
-            print 'No action requested'
-            return
-        actions = self.get_actions()
-        action = None
+            raise ValueError('No action requested')
         for a in actions:
             if a[0] == name:
                 action = a
                 break
         else:
-            print 'action is not valid'
-            return
+            raise ValueError('action is not valid')
         attribs = {'action': name}
         for i, opt in enumerate(options):
-            ac = action[3][i]
+            try:
+                ac = action[3][i]
+            except IndexError:
+                raise ValueError('invalid option')
             if opt in ac[2]:
                 attribs[ac[0]] = opt
             elif opt == ac[1]:
                 attribs[ac[0]] = opt
             else:
-                print 'invalid option'
-                return
+                raise ValueError('invalid option')
+        return attribs
+
+    def act(self, action, comment=''):
+        """ Perform an action on current ticket """
+        # the actions loaded with the view may be outdated by now, they are
+        # only shared with the other getActions of this command
+        try:
+            attribs = self.action_attribs(action, self.get_actions())
+        except ValueError, e:
+            print e
+            return
         self.update(comment, attribs)
 
-    def get_options(self, op_id=0, type_='attrib'):
-        options = {
-            'attrib': self.attribs[op_id],
-            'field': ['component', 'milestone', 'owner', 'priority',
-                      'reporter', 'status', 'type', 'version'],
-            'action': self.actions,
-        }.get(type_, [])
-        vim.command('let g:tracOptions="{0}"'.format("|".join(options)))
+    def bulk_plan(self, attribs=None, action=None):
+        """ Works out the changes for every ticket matching the current
+            filters. Returns a list of (ticket id, attribs, error) """
+        tids = trac.server.ticket.query(self.query_string(True))
+        if not action:
+            return [(tid, attribs, None) for tid in tids]
+
+        plan = []
+        calls = [('ticket.getActions', (tid,)) for tid in tids]
+        for call, actions, error in multicall_chunks(trac.server, calls):
+            tid = call[1][0]
+            if error is None:
+                try:
+                    plan.append((tid, self.action_attribs(action, actions),
+                                 None))
+                    continue
+                except ValueError, e:
+                    error = e
+            plan.append((tid, None, error))
+        return plan
+
+    def bulk_update(self, plan, comment=''):
+        """ Sends the planned changes in MultiCall batches. Returns a list of
+            (ticket id, error) """
+        calls = [('ticket.update', (tid, comment, attribs, False))
+                 for tid, attribs, error in plan if error is None]
+        return [(call[1][0], error) for call, result, error
+                in multicall_chunks(trac.server, calls)]
+
+    def bulk_report(self, title, plan, results=()):
+        """ Formats a bulk update plan or its results for the ticket window """
+        failures = dict(results)
+        str_report = ["= {0} =".format(title), ""]
+        for tid, attribs, error in plan:
+            if error is not None:
+                str_report.append(" * #{0}: skipped - {1}".format(tid, error))
+            elif failures.get(tid) is not None:
+                error = failures[tid]
+                str_report.append(" * #{0}: failed - {1}".format(tid,
+                                  getattr(error, 'faultString', error)))
+            else:
+                changes = ', '.join(['{0}={1}'.format(k, v) for k, v
+                                     in attribs.iteritems()])
+                str_report.append(" * #{0}: {1}".format(tid, changes))
+        return '\n'.join(str_report)
+
+    def export(self, path, changelog=False):
+        """
+        Streams every ticket of the current query to path, as JSON lines or
+        as CSV when path ends in .csv, one MultiCall chunk of g:tracBatchSize
+        tickets at a time, optionally with their changelogs. Yields (done,
+        total) after each chunk. The progress is stored next to path, an
+        interrupted export of the same query resumes after its last chunk.
+        """
+        if not self.fields:
+            self.get_attribs()
+        query = self.query_string(True)
+        progress_cache = DiskCache(os.path.dirname(os.path.abspath(path)))
+        name = os.path.basename(path) + '.progress'
+        progress = progress_cache.load(name)[0]
+        if not (progress and os.path.exists(path) and
+                [progress['query'], progress['changelog']] == [query,
+                                                               changelog]):
+            columns = ['id', 'time', 'changetime']
+            columns.extend(f['name'] for f in self.fields
+                           if f['name'] not in columns)
+            if changelog:
+                columns.append('changelog')
+            progress = {'query': query, 'changelog': changelog,
+                        'columns': columns, 'done': 0, 'offset': 0,
+                        'ids': trac.server.ticket.query(query)}
+        ids, columns = progress['ids'], progress['columns']
+        as_csv = path.lower().endswith('.csv')
+
+        def cell(value):
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            if isinstance(value, (list, dict)):
+                return json.dumps(value, default=str)
+            return '' if value is None else str(value)
+
+        # results must not pile up in the command's request scope
+        server = RequestScope(trac.server.proxy, trac.server.retries)
+        size = batch_size()
+        with open(path, 'r+b' if progress['offset'] else 'wb') as fp:
+            fp.seek(progress['offset'])
+            fp.truncate()
+            writer = csv.writer(fp)
+            if as_csv and not progress['offset']:
+                writer.writerow(columns)
+            for start in xrange(progress['done'], len(ids), size):
+                chunk = ids[start:start + size]
+                calls = [('ticket.get', (tid, )) for tid in chunk]
+                if changelog:
+                    calls.extend(('ticket.changeLog', (tid, ))
+                                 for tid in chunk)
+                results = list(multicall_chunks(server, calls, len(calls)))
+                for call, result, error in results:
+                    if error and not isinstance(error, xmlrpclib.Fault):
+                        raise error
+                for i, (call, ticket, error) in enumerate(results[:len(chunk)]):
+                    if error:   # deleted since the query
+                        continue
+                    record = dict(ticket[3], id=ticket[0], time=ticket[1],
+                                  changetime=ticket[2])
+                    if changelog:
+                        record['changelog'] = results[len(chunk) + i][1] or []
+                    if as_csv:
+                        writer.writerow([cell(record.get(c)) for c in columns])
+                    else:
+                        fp.write(json.dumps(record, default=str) + '\n')
+                fp.flush()
+                progress['done'] = start + len(chunk)
+                progress['offset'] = fp.tell()
+                progress_cache.store(name, progress)
+                yield progress['done'], len(ids)
+        try:
+            os.remove(progress_cache.path(name))
+        except OSError:
+            pass
+
+    def options(self, kind):
+        """ returns the completion candidates of an attribute, the ticket
+            fields or the current actions """
+        if kind == 'action':
+            return self.actions
+        if not self.attribs:
+            self.get_attribs()
+        if kind == 'field':
+            return [f['name'] for f in self.fields] or ['component',
+                    'milestone', 'owner', 'priority', 'reporter', 'status',
+                    'type', 'version']
+        return self.attribs[self.attrib_names.index(kind)]
 
 
 class TracTicketUI(UI):
@@ -837,6 +2850,8 @@ class TicketWindow(NonEditableWindow):
                     ':python trac.ticket_view(direction=1)<cr>')
         vim.command('nnoremap <buffer> ws '
                     ':python print trac.ticket.visited_tickets<cr>')
+        vim.command('nnoremap <buffer> wh '
+                    ':python trac.ticket_more_history()<cr>')
         vim.command('setlocal noswapfile')
         vim.command('setlocal textwidth=100')
         vim.command('setlocal syntax=tracwiki')
@@ -978,6 +2993,144 @@ class TracTimelineWindow(NonEditableWindow):
         vim.command('setlocal noswapfile')
 
 
+class TracDashboard(object):
+    """
+    Ticket counts by status, milestone, owner and component. The tickets of
+    every value are fetched with one MultiCall of ticket.query and kept,
+    later views only fetch the tickets changed since.
+    """
+    def __init__(self):
+        self.reset_attrs()
+
+    def reset_attrs(self):
+        self.values = []
+        self.members = {}
+        self.since = None
+        self.updated = None
+        self.rows = []
+
+    def get_values(self):
+        """ The options get_attribs loaded and the owners of the listed
+            tickets, each with '' for tickets without one """
+        attribs = dict(zip(TracTicket.attrib_names, trac.ticket.attribs))
+        owners = set(t[3].get('owner', '') for t in trac.ticket.tickets)
+        owners.update([trac.user, ''])
+        return [('status', attribs.get('status', [])),
+                ('milestone', attribs.get('milestone', []) + ['']),
+                ('owner', sorted(owners)),
+                ('component', attribs.get('component', []) + [''])]
+
+    def refresh(self, recount=False):
+        """ Counts all tickets the first time or when recount is set,
+            otherwise only moves the tickets changed since the last time """
+        now = xmlrpclib.DateTime(time.gmtime())
+        if recount or not self.members:
+            self.count()
+        else:
+            self.update()
+        self.since = now
+        self.updated = time.strftime('%H:%M')
+
+    def count(self):
+        self.values = self.get_values()
+        keys = [(field, value) for field, options in self.values
+                for value in options if query_value(value) is not None]
+        calls = [('ticket.query', (u'{0}={1}&max=0'.format(
+                  field, query_value(value)), )) for field, value in keys]
+        self.members = {}
+        for key, (call, tickets, error) in zip(keys, multicall_chunks(
+                trac.server, calls, len(calls))):
+            if isinstance(error, xmlrpclib.Fault):
+                continue
+            elif error:
+                raise error
+            self.members[key] = set(tickets)
+
+    def update(self):
+        changed = trac.server.ticket.getRecentChanges(self.since)
+        calls = [('ticket.get', (tid, )) for tid in changed]
+        for (method, (tid, )), ticket, error in multicall_chunks(trac.server,
+                                                                 calls):
+            if error and not isinstance(error, xmlrpclib.Fault):
+                raise error
+            for tickets in self.members.itervalues():
+                tickets.discard(tid)
+            if error:   # deleted
+                continue
+            for field, options in self.values:
+                tickets = self.members.get((field, ticket[3].get(field, '')))
+                if tickets is not None:
+                    tickets.add(tid)
+
+    def render(self):
+        """ Milestone progress, tickets per status and the open tickets
+            per owner and component. rows maps lines to their (field, value) """
+        closed = self.members.get(('status', 'closed'), set())
+        lines = ['Hit <enter> on a line to list its open tickets', '',
+                 '= Dashboard (updated {0}) ='.format(self.updated)]
+        self.rows = [None, None, None]
+
+        def add(line, row=None):
+            lines.append(line)
+            self.rows.append(row)
+        for field, options in self.values:
+            counted = [(value, self.members[(field, value)])
+                       for value in options if (field, value) in self.members]
+            add('')
+            add('== {0} =='.format(field.title()))
+            if field == 'owner':
+                counted.sort(key=lambda c: -len(c[1] - closed))
+            for value, tickets in counted:
+                name = value or u'(none)'
+                if field == 'status':
+                    add(u' {0:<24} {1:>5}'.format(name, len(tickets)),
+                        (field, value))
+                    continue
+                opened = len(tickets - closed)
+                if field == 'milestone':
+                    done = len(tickets) - opened
+                    percent = 100 * done / len(tickets) if tickets else 0
+                    line = (u' {0:<24} {1:>5} open {2:>5} closed {3:>4}% '
+                            u'[{4:<10}]')
+                    add(line.format(name, opened, done, percent,
+                                    '#' * (percent / 10)), (field, value))
+                elif opened:
+                    add(u' {0:<24} {1:>5} open'.format(name, opened),
+                        (field, value))
+        return '\n'.join(lines)
+
+    def row(self, line):
+        """ The (field, value) shown on a 1-based line """
+        if 0 < line <= len(self.rows):
+            return self.rows[line - 1]
+
+
+class TracDashboardUI(UI):
+    """ UI Manager for the Dashboard View """
+    def __init__(self):
+        self.dashboard_window = TracDashboardWindow()
+
+    def create(self):
+        self.dashboard_window.create('belowright new')
+
+    def destroy(self):
+        self.dashboard_window.destroy()
+
+
+class TracDashboardWindow(NonEditableWindow):
+    """ Ticket Counts Window """
+    def __init__(self, name='DASHBOARD_WINDOW'):
+        NonEditableWindow.__init__(self, name)
+
+    def on_create(self):
+        vim.command('nnoremap <buffer> <cr> '
+                    ':python trac.dashboard_select()<cr>')
+        vim.command('setlocal syntax=tracwiki')
+        vim.command('setlocal cursorline')
+        vim.command('setlocal nowrap')
+        vim.command('setlocal noswapfile')
+
+
 class Trac(object):
     """ Main Trac class """
     def __init__(self):
@@ -986,12 +3139,14 @@ class Trac(object):
         self.search = TracSearch()
         self.ticket = TracTicket()
         self.timeline = TracTimeline()
+        self.dashboard = TracDashboard()
 
         self.uiwiki = TracWikiUI()
         self.uiserver = TracServerUI()
         self.uiticket = TracTicketUI()
         self.uisearch = TracSearchUI()
         self.uitimeline = TracTimelineUI()
+        self.uidashboard = TracDashboardUI()
 
         self.server_list = vim.eval('g:tracServerList')
         default_server = vim.eval('g:tracDefaultServer')
@@ -999,11 +3154,305 @@ class Trac(object):
         if not comment:
             comment = 'VimTrac update'
 
+        self.pending = Queue.Queue()
+        self.jobs = 0
+        self.timer = None
+        self.watcher = 0
+        self.watch_state = None
+        self.cache = LRUCache(int(vim.eval('g:tracCacheSize')) * 1024,
+                              int(vim.eval('g:tracCacheTTL')))
+        self.session_cache = DiskCache(vim.eval('g:tracCacheDirectory'))
+        session = None
+        if int(vim.eval('g:tracRestoreSession')):
+            session = self.session_cache.load('session')[0]
+        # the last server only stands in for a missing g:tracDefaultServer
+        if (session and session['server'] in self.server_list and
+                default_server not in self.server_list):
+            default_server = session['server']
+
         self.set_server(default_server)
         self.default_comment = comment
+        if session and session['server'] == default_server:
+            self.restore_session(session)
+
+    def restore_session(self, session):
+        """ Restores the state saved by save_session. The last rendered
+            views are kept to paint the first wiki/ticket view instantly """
+        self.wiki.current_page = session['wiki']['current_page']
+        self.wiki.visited_pages = session['wiki']['visited_pages']
+        self.wiki.watched = session['wiki'].get('watched', [])
+        self.ticket.watched = session['ticket'].get('watched', [])
+        for attr in ('current_ticket_id', 'visited_tickets', 'filters',
+                     'sorter', 'page'):
+            setattr(self.ticket, attr, session['ticket'][attr])
+        self.snapshot = session['rendered']
+
+    def save_session(self):
+        """ Stores the current server, view state and rendered views """
+        rendered = dict(self.snapshot)
+        if 'wiki' in self.rendered:
+            page, text = self.rendered['wiki']
+            rendered['wiki'] = {'page': page, 'text': text,
+                                'pages': self.wiki.pages,
+                                'attachments': self.wiki.attachments}
+        if 'ticket' in self.rendered:
+            tid, text = self.rendered['ticket']
+            style, list_text = self.rendered.get('ticket_list', (None, ''))
+            rendered['ticket'] = {'tid': tid, 'text': text, 'style': style,
+                                  'list': list_text,
+                                  'attachments': self.ticket.attachments,
+                                  'attachment_info':
+                                  self.ticket.attachment_info}
+        self.session_cache.store('session', {
+            'server': self.server_name,
+            'wiki': {
+                'current_page': self.wiki.current_page,
+                'visited_pages': self.wiki.visited_pages,
+                'watched': self.wiki.watched,
+            },
+            'ticket': {
+                'current_ticket_id': self.ticket.current_ticket_id,
+                'visited_tickets': self.ticket.visited_tickets,
+                'watched': self.ticket.watched,
+                'filters': self.ticket.filters,
+                'sorter': self.ticket.sorter,
+                'page': self.ticket.page,
+            },
+            'rendered': rendered,
+        })
+        self.disk_cache.store('links', self.wiki.links)
+
+    def defer(self, func, *args):
+        """ Queues func to run on vim's thread. Background threads use this
+            to hand their results to the UI """
+        self.pending.put((func, args))
+
+    def process_pending(self):
+        """ Runs the deferred calls, called from a timer/CursorHold. The
+            timer is only kept while background work runs or the watcher
+            waits for its next poll """
+        if self.timer:
+            vim.command('call timer_stop({0})'.format(self.timer[0]))
+            self.timer = None
+        while True:
+            try:
+                func, args = self.pending.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception, e:
+                print 'Background update failed: {0}'.format(e)
+        self.poll_watcher()
+        if self.jobs:
+            self.schedule(0.5)
+        elif self.watch_state:
+            self.schedule(self.watch_state['due'] - time.time())
+
+    def schedule(self, delay):
+        """ Has vim call process_pending in delay seconds, unless it is
+            due earlier already. Without timers CursorHold calls it """
+        due = time.time() + max(delay, 0.5)
+        if self.timer and self.timer[1] <= due:
+            return
+        if self.timer:
+            vim.command('call timer_stop({0})'.format(self.timer[0]))
+        timer = int(vim.eval('TracSchedulePending({0})'.format(
+                    int((due - time.time()) * 1000))))
+        self.timer = (timer, due) if timer >= 0 else None
+
+    def background(self, func, *args):
+        """ Runs func in the background, process_pending keeps being called
+            until it finished """
+        self.jobs += 1
+
+        def work():
+            try:
+                func(*args)
+            finally:
+                self.defer(self.background_done)
+        run_in_background(work)
+        self.schedule(0.5)
+
+    def background_done(self):
+        self.jobs -= 1
+
+    def revalidate(self, fetch, apply, *args):
+        """ Runs fetch(proxy, *args) in the background and passes its result
+            to apply on vim's thread """
+        proxy = self.make_server_proxy()
+
+        def work():
+            self.defer(apply, fetch(proxy, *args))
+        self.background(work)
+
+    def start_watcher(self):
+        """ Starts polling the recent changes of the current server, a poll
+            of any previous watcher is ignored """
+        self.watcher += 1
+        self.changes = set()
+        self.show_changes()
+        self.watch_state = None
+        interval = int(vim.eval('g:tracWatchInterval'))
+        if interval > 0:
+            start = xmlrpclib.DateTime(time.gmtime())
+            self.watch_state = {
+                'proxy': self.make_server_proxy(),
+                'minimum': interval,
+                'maximum': int(vim.eval('g:tracWatchMaxInterval')),
+                'interval': interval,
+                'due': time.time() + interval,
+                'polling': False,
+                'marks': {'ticket': [start, set()], 'wiki': [start, set()]},
+            }
+            self.schedule(interval)
+
+    def poll_watcher(self):
+        """ Starts the background poll of the watcher once it is due. The
+            interval doubles up to the maximum while nothing watched changes
+            and drops back to the minimum when something does """
+        watch = self.watch_state
+        if not watch or watch['polling'] or time.time() < watch['due']:
+            return
+        watch['polling'] = True
+        watcher = self.watcher
+        tickets, pages = self.watched()
+
+        def work():
+            changed = None
+            try:
+                changed = self.poll_changes(watch['proxy'], watch['marks'],
+                                            tickets, pages)
+            finally:
+                self.defer(self.watch_polled, watcher, changed)
+        self.background(work)
+
+    def watch_polled(self, watcher, changed):
+        """ Takes the (tickets, pages) a poll found changed, None when it
+            failed, and sets the time of the next poll """
+        if watcher != self.watcher:
+            return
+        watch = self.watch_state
+        watch['polling'] = False
+        if changed and (changed[0] or changed[1]):
+            watch['interval'] = watch['minimum']
+            self.watch_changed(watcher, *changed)
+        else:
+            watch['interval'] = min(watch['interval'] * 2, watch['maximum'])
+        watch['due'] = time.time() + watch['interval']
+
+    def poll_changes(self, proxy, marks, tickets, pages):
+        """ A single MultiCall of both getRecentChanges, returns the tickets
+            and pages out of those given that changed. Each realm polls from
+            the newest server time it received, only the first poll goes by
+            the local clock """
+        multicall = xmlrpclib.MultiCall(proxy)
+        multicall.ticket.getRecentChanges(marks['ticket'][0])
+        multicall.wiki.getRecentChanges(marks['wiki'][0])
+        changed_tickets, changed_pages = multicall()
+        calls = [('ticket.get', (t, )) for t in changed_tickets]
+        results = list(multicall_chunks(proxy, calls, len(calls) or 1))
+        for call, ticket, error in results:
+            if error and not isinstance(error, xmlrpclib.Fault):
+                raise error
+        # deleted tickets fail with a fault and are left out
+        changed_tickets = self.advance_mark(marks['ticket'], [
+                (call[1][0], ticket[2]) for call, ticket, error in results
+                if not error])
+        changed_pages = self.advance_mark(marks['wiki'], [
+                (p['name'], p['lastModified']) for p in changed_pages])
+        tickets.intersection_update(changed_tickets)
+        pages.intersection_update(changed_pages)
+        return tickets, pages
+
+    @staticmethod
+    def advance_mark(mark, stamped):
+        """ Moves a [time, names seen at that time] poll mark to the newest
+            of the (name, server time) pairs. The server also answers the
+            changes at the mark, returns the names not seen before """
+        since, seen = mark[0], mark[1]
+        changed = []
+        for name, stamp in stamped:
+            if str(stamp) > str(since) or name not in seen:
+                changed.append(name)
+            if str(stamp) > str(mark[0]):
+                mark[:] = [stamp, set([name])]
+            elif str(stamp) == str(mark[0]):
+                mark[1].add(name)
+        return changed
+
+    def watched(self):
+        """ The tickets and pages the watcher reports: the visited ones and
+            those added with watch """
+        return (set(self.ticket.visited_tickets + self.ticket.watched),
+                set(self.wiki.visited_pages + self.wiki.watched))
+
+    def watch(self, kind, name=None):
+        """ Toggles watching a ticket or wiki page, by default the open one """
+        if kind == 'ticket':
+            watched = self.ticket.watched
+            name = name or self.ticket.current_ticket_id
+            label = '#{0}'
+        else:
+            watched = self.wiki.watched
+            name = name or self.wiki.current_page
+            label = '{0}'
+        if not name:
+            print 'Nothing to watch'
+            return
+        if kind == 'ticket':
+            name = int(name)
+        if name in watched:
+            watched.remove(name)
+            print 'Stopped watching', label.format(name)
+        else:
+            watched.append(name)
+            print 'Watching', label.format(name)
+
+    def watch_changed(self, watcher, tickets, pages):
+        """ Refreshes the open ticket or page when it changed, other changes
+            are listed in the status line until they are viewed """
+        if watcher != self.watcher:
+            return
+        tid = self.ticket.current_ticket_id
+        if tid in tickets and self.uiticket.mode != 0:
+            tickets.discard(tid)
+            self.revalidate(self.ticket.fetch,
+                            lambda result: self.update_ticket_view(tid,
+                                                                   result),
+                            tid, self.ticket.query_string())
+        page = self.wiki.current_page
+        if page in pages and self.uiwiki.mode != 0:
+            pages.discard(page)
+            text = self.rendered.get('wiki', (None, ''))[1]
+            self.revalidate(self.wiki.fetch,
+                            lambda result: self.update_wiki(page, text, result),
+                            page)
+        self.changes.update(['#{0}'.format(t) for t in tickets])
+        self.changes.update(pages)
+        self.show_changes()
+
+    def seen(self, name):
+        """ Clears a viewed ticket (#id) or page from the status line """
+        if name in self.changes:
+            self.changes.discard(name)
+            self.show_changes()
+
+    def show_changes(self):
+        """ Sets g:tracWatchStatus, shown by TracWatchStatus() """
+        status = ''
+        if self.changes:
+            status = 'Trac: {0} changed'.format(' '.join(sorted(self.changes)))
+        if isinstance(status, unicode):
+            status = status.encode('utf-8')
+        vim.command("let g:tracWatchStatus = '{0}'".format(
+                    status.replace("'", "''")))
+        vim.command('redrawstatus!')
 
     def set_server(self, server):
         url = self.server_list[server]
+        if self.wiki.links:
+            self.disk_cache.store('links', self.wiki.links)
         self.server_name = server
         self.server_url = {
             'scheme': url.get('scheme', 'http'),
@@ -1011,23 +3460,92 @@ class Trac(object):
             'rpc_path': url.get('rpc_path', 'login/rpc'),
             'auth': url.get('auth', ''),
         }
-        scheme = url.get('scheme', 'http')
-        auth = url.get('auth', '').split(':')
-
-        if len(auth) == 2:  # Basic authentication
-            url = '{scheme}://{auth}@{server}{rpc_path}'.format(**url)
-        else:   # Anonymous or Digest authentication
-            url = '{scheme}://{server}{rpc_path}'.format(**url)
-        if len(auth) == 3:  # Digest authentication
-            transport = HTTPDigestTransport(scheme, *auth)
-            self.server = xmlrpclib.ServerProxy(url, transport=transport)
-        else:
-            self.server = xmlrpclib.ServerProxy(url)
+        if int(vim.eval('g:tracDaemon')):
+            self.start_daemon()
+        self.server = RequestScope(self.make_server_proxy(url),
+                                   int(vim.eval('g:tracRetries')))
+        self.session = TracSession(self.server_url, self.timeouts(url)[1])
+        self.list_fetch = url.get('list_fetch', 'rpc')
+        self.disk_cache = DiskCache(os.path.join(
+                vim.eval('g:tracCacheDirectory'),
+                re.sub(r'[^\w.-]', '_', server)))
+        self.attachment_store = AttachmentStore(self.disk_cache)
 
         self.wiki.reset_attrs()
         self.ticket.reset_attrs()
+        self.search.reset_attrs()
+        self.dashboard.reset_attrs()
+        self.wiki.links = self.disk_cache.load('links')[0] or {}
+        self.cache.clear()
+        self.completions = {}
+        self.rendered = {}
+        self.snapshot = {}
         self.user = self.get_user()
-
+        self.start_watcher()
+
+    def make_server_proxy(self, url=None):
+        """ Builds an xmlrpc proxy for a g:tracServerList entry, by default
+            the current server. Background threads need their own proxy """
+        if url is None:
+            url = self.server_list[self.server_name]
+        url = dict(url)
+        url['connect_timeout'], url['read_timeout'] = self.timeouts(url)
+        if not int(vim.eval('g:tracDaemon')):
+            return server_proxy(url)
+        transport = DaemonTransport(self.daemon_socket(), url)
+        # the daemon may be busy with requests of other vims
+        transport.read_timeout = 2 * (url['connect_timeout'] +
+                                      url['read_timeout'])
+        return xmlrpclib.ServerProxy('http://trac-daemon/RPC2',
+                                     transport=transport)
+
+    def daemon_socket(self):
+        return os.path.expanduser(vim.eval('g:tracDaemonSocket'))
+
+    def start_daemon(self):
+        """ Starts trac_daemon.py unless it is listening already """
+        path = self.daemon_socket()
+        for attempt in xrange(30):
+            try:
+                UnixHTTPConnection(path, 1).connect()
+                return
+            except socket.error:
+                pass
+            if not attempt:
+                try:
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    with open(os.devnull, 'w') as devnull:
+                        subprocess.Popen([vim.eval('g:tracDaemonPython'),
+                                          vim.eval('g:tracDaemonScript'), path,
+                                          '--ttl', vim.eval('g:tracDaemonTTL')],
+                                         stdout=devnull, stderr=devnull,
+                                         close_fds=True, preexec_fn=os.setsid)
+                except OSError, e:
+                    print 'trac_daemon.py could not be run ({0})'.format(e)
+                    break
+            time.sleep(0.1)
+        print 'trac_daemon.py did not start, g:tracDaemon is ignored'
+        vim.command('let g:tracDaemon = 0')
+
+    def timeouts(self, url):
+        """ Connect and read timeouts of a g:tracServerList entry """
+        return (float(url.get('connect_timeout',
+                              vim.eval('g:tracConnectTimeout'))),
+                float(url.get('read_timeout', vim.eval('g:tracReadTimeout'))))
+
+    def list_state(self):
+        """ The ticket list settings a failed command restores """
+        return (self.ticket.page, dict(self.ticket.filters),
+                dict(self.ticket.sorter))
+
+    def restore_list_state(self, state):
+        page, filters, sorter = state
+        self.ticket.page = page
+        self.ticket.filters = filters
+        self.ticket.sorter = sorter
+
+    @command
     def wiki_view(self, page=False, direction=None):
         """ Creates The Wiki View """
         print 'Connecting...'
@@ -1046,19 +3564,144 @@ class Trac(object):
             else:
                 page = 'WikiStart'
 
+        if page != self.wiki.current_page:
+            self.wiki.diff_revision = None
+
+        snapshot = self.snapshot.pop('wiki', None)
+        prefetched = self.cache.get(('page', page))
+        # an old copy would be edited and saved over newer text
+        if prefetched and time.time() - prefetched[2] > self.wiki.prefetch_ttl:
+            self.cache.discard(('page', page))
+            prefetched = None
+        if prefetched and not (snapshot and snapshot['page'] == page):
+            # shown once, the next view of the page fetches it again
+            self.cache.discard(('page', page))
+            remember(self.wiki.visited_pages, page)
+            snapshot = {'page': page, 'text': prefetched[0],
+                        'pages': self.wiki.pages,
+                        'attachments': prefetched[1]}
+        if snapshot and snapshot['page'] == page:
+            text = snapshot['text']
+            self.wiki.current_page = page
+            self.wiki.set_pages(snapshot['pages'])
+            self.wiki.attachments = snapshot['attachments']
+            self.revalidate(self.wiki.fetch,
+                            lambda result: self.update_wiki(page, text, result),
+                            page)
+        else:
+            self.wiki.get_all_pages()
+            text = self.wiki.get_page(page)
+            self.wiki.list_attachments()
+
         self.normal_view()
 
         self.uiwiki.open()
-        self.uiwiki.tocwindow.write(self.wiki.get_all_pages())
-        self.uiwiki.wikiwindow.write(self.wiki.get_page(page))
-
-        self.wiki.list_attachments()
+        self.seen(page)
+        self.wiki.reveal_toc(page)
+        self.uiwiki.tocwindow.write(self.wiki.render_toc())
+        self.uiwiki.wikiwindow.write(text)
+        self.rendered['wiki'] = (page, text)
+        self.wiki.note_links(page, text)
+        self.wiki.prefetch_links(page)
+        if self.uiwiki.historywindow.get_winnr() > 0:
+            self.wiki.load_history()
+            self.uiwiki.historywindow.write(self.wiki.render_history())
+        if self.uiwiki.backlinkswindow.get_winnr() > 0:
+            self.wiki_backlinks()
 
         if self.wiki.attachments:
             self.uiwiki.attachwindow.create('belowright 3 new')
             self.uiwiki.attachwindow.write("\n".join(self.wiki.attachments))
         self.uiwiki.wikiwindow.set_focus()
 
+    def update_wiki(self, page, text, result):
+        """ Refreshes a wiki view painted from the session snapshot """
+        if self.uiwiki.mode == 0 or self.wiki.current_page != page:
+            return
+        pages, new_text, info, attachments = result
+        winnr = vim.eval('winnr()')
+        self.wiki.revision = info['version']
+        self.wiki.attachments = attachments
+        if pages != self.wiki.pages:
+            self.wiki.set_pages(pages)
+            self.uiwiki.tocwindow.write(self.wiki.render_toc())
+        self.wiki.note_links(page, new_text)
+        # leave the page alone once the user started editing it
+        if (new_text != text and
+                self.uiwiki.wikiwindow.dump() == text.encode('utf-8')):
+            self.uiwiki.wikiwindow.write(new_text)
+            self.rendered['wiki'] = (page, new_text)
+        vim.command('{0}wincmd w'.format(winnr))
+
+    @command
+    def wiki_toc_select(self):
+        """ Opens the page under the cursor in the toc or toggles its node
+            when there is no such page """
+        path, is_page, has_children = self.wiki.toc_entry()
+        if is_page:
+            self.wiki_view(path)
+        elif has_children:
+            self.wiki_toc_toggle()
+
+    @command
+    def wiki_toc_preview(self):
+        """ Opens the page under the cursor in the toc in the browser, does
+            nothing on nodes that are not pages """
+        path, is_page, has_children = self.wiki.toc_entry()
+        if is_page:
+            self.wiki.html_view(path)
+
+    @command
+    def wiki_diff(self, revision=None, step=0):
+        """ Shows revision of the current page in the diff split, or the
+            one step revisions away from the shown one """
+        if step:
+            self.wiki.step_diff(step)
+        else:
+            self.wiki.vim_diff(revision)
+
+    @command
+    def wiki_history(self):
+        """ Lists the revisions of the current page """
+        self.wiki.get_page_info()
+        self.wiki.load_history()
+        historywindow = self.uiwiki.historywindow
+        if historywindow.get_winnr() < 0:
+            self.uiwiki.wikiwindow.set_focus()
+            historywindow.create('belowright 10 new')
+        historywindow.write(self.wiki.render_history())
+        self.wiki.prefetch_revisions(self.wiki.revision - 1)
+
+    def wiki_backlinks(self):
+        """ Lists the pages known to link to the current page """
+        page = self.wiki.current_page
+        backlinks = self.wiki.backlinks(page)
+        window = self.uiwiki.backlinkswindow
+        if window.get_winnr() < 0:
+            self.uiwiki.wikiwindow.set_focus()
+            window.create('belowright 8 new')
+        window.write('\n'.join(backlinks))
+        print '{0} pages link to {1} ({2} of {3} pages indexed)'.format(
+              len(backlinks), page,
+              len(set(self.wiki.links).intersection(self.wiki.pages)),
+              len(self.wiki.pages))
+
+    def wiki_history_select(self):
+        """ Diffs the page against the revision under the cursor """
+        match = re.match(r'^\W*v(\d+)', vim.current.line)
+        if match:
+            self.wiki_diff(int(match.group(1)))
+
+    def wiki_toc_toggle(self):
+        """ Expands or collapses the toc node under the cursor """
+        path, is_page, has_children = self.wiki.toc_entry()
+        if not has_children:
+            return
+        cursor = vim.current.window.cursor
+        self.uiwiki.tocwindow.write(self.wiki.toggle_toc(path))
+        vim.current.window.cursor = cursor
+
+    @command
     def ticket_view(self, tid=False, cached=False, direction=None):
         """ Creates The Ticket View """
         print 'Connecting...'
@@ -1088,50 +3731,135 @@ class Trac(object):
                 print 'Error: History out of range'
                 return
 
+        snapshot = self.snapshot.pop('ticket', None)
+        style = vim.eval('g:tracTicketStyle')
+        if (snapshot and snapshot['tid'] == tid and
+                snapshot['style'] == style):
+            text, list_text = snapshot['text'], snapshot['list']
+            self.ticket.attachments = snapshot['attachments']
+            self.ticket.attachment_info = snapshot.get('attachment_info', {})
+            self.revalidate(self.ticket.fetch,
+                            lambda result: self.update_ticket_view(tid,
+                                                                   result),
+                            tid, self.ticket.query_string())
+        else:
+            text = self.ticket.get(tid)
+            list_text = None
+
         self.normal_view()
         self.uiticket.open()
 
-        self.uiticket.ticketwindow.write(self.ticket.get(tid))
+        self.uiticket.ticketwindow.write(text)
+        self.rendered['ticket'] = (tid, text)
+        self.seen('#{0}'.format(self.ticket.current_ticket_id))
         if self.ticket.attachments:
             self.uiticket.attachwindow.create('belowright 3 new')
             self.uiticket.attachwindow.write("\n".join(
                                              self.ticket.attachments))
 
-        style = vim.eval('g:tracTicketStyle')
-        if style == 'summary':
-            self.uiticket.summarywindow.write(self.ticket.get_all(True,
-                                                                  cached))
-        else:
-            self.uiticket.tocwindow.write(self.ticket.get_all(False, cached))
+        if list_text is None:
+            list_text = self.ticket.get_all(style == 'summary', cached,
+                                            self.ticket_list_progress())
+        self.show_ticket_list(list_text)
 
         if self.ticket.current_ticket_id:
             self.uiticket.ticketwindow.set_focus()
 
+    def ticket_more_history(self):
+        """ Expands older changes of the current ticket """
+        if not self.ticket.current_ticket:
+            return
+        self.uiticket.ticketwindow.write(self.ticket.more_history())
+
+    def update_ticket_view(self, tid, result):
+        """ Refreshes a ticket view painted from the session snapshot """
+        if self.uiticket.mode == 0 or self.ticket.current_ticket_id != tid:
+            return
+        current, tickets = result
+        winnr = vim.eval('winnr()')
+        self.ticket.load(*current)
+        self.ticket.set_rows(tickets)
+        text = self.ticket.render()
+        if text != self.rendered.get('ticket', (None, None))[1]:
+            self.uiticket.ticketwindow.write(text)
+            self.rendered['ticket'] = (tid, text)
+        style = vim.eval('g:tracTicketStyle')
+        list_text = self.ticket.get_all(style == 'summary', True)
+        if self.rendered.get('ticket_list') != (style, list_text):
+            self.show_ticket_list(list_text)
+        vim.command('{0}wincmd w'.format(winnr))
+
+    @command
+    def ticket_list_view(self, cached=False):
+        """ Writes the ticket list to the summary or contents window """
+        style = vim.eval('g:tracTicketStyle')
+        self.show_ticket_list(self.ticket.get_all(
+                              style == 'summary', cached,
+                              self.ticket_list_progress()))
+
+    def ticket_list_progress(self):
+        """ Shows the rows of a ticket list as their batches arrive. The
+            final write of the whole list aligns and highlights them """
+        if vim.eval('g:tracTicketStyle') == 'summary':
+            window = self.uiticket.summarywindow
+        else:
+            window = self.uiticket.tocwindow
+        started = []
+
+        def progress(lines, done, total):
+            window.extend(lines, not started)
+            started.append(done)
+            vim.command('redraw')
+            print 'Fetching tickets... {0}/{1}'.format(done, total)
+        return progress
+
+    def show_ticket_list(self, text):
+        """ Writes a rendered ticket list """
+        style = vim.eval('g:tracTicketStyle')
+        if style == 'summary':
+            self.uiticket.summarywindow.write(text)
+        else:
+            self.uiticket.tocwindow.write(text)
+        self.rendered['ticket_list'] = (style, text)
+
+    def arrange_ticket_list(self):
+        """ Shows the list for changed sort/filter settings, arranged from
+            the tickets at hand when they hold the whole result set """
+        if self.ticket.arrange():
+            self.ticket_list_view(True)
+        else:
+            self.ticket_view()
+
+    @command
     def sort_ticket(self, sorter, attr):
         self.ticket.set_sort_attr(sorter, attr)
-        self.ticket_view()
+        self.arrange_ticket_list()
 
+    @command
     def filter_ticket(self, attrib, value, ignore=False):
         self.ticket.filters[attrib] = '{0}{1}'.format('!' if ignore else '',
                                                       value)
-        self.ticket_view()
+        self.arrange_ticket_list()
 
+    @command
     def filter_clear(self, attrib=None):
         if attrib:
             del self.ticket.filters[attrib]
         else:
             self.ticket.filters = {}
-        self.ticket_view()
+        self.arrange_ticket_list()
 
+    @command
     def ticket_paginate(self, direction=1):
         try:
             self.ticket.page += direction
             self.ticket_view()
-        except:
+        except xmlrpclib.Fault:
             self.ticket.page -= direction
             self.ticket_view()
             print 'cannot go beyond current page'
 
+    @command
     def create_ticket(self, type_=False, summary='new ticket'):
         """ writes comment window to a new  ticket  """
         if self.uiticket.mode == 0:
@@ -1151,6 +3879,74 @@ class Trac(object):
         self.ticket.create(description, summary, attribs)
         self.ticket_view(trac.ticket.current_ticket_id)
 
+    def mirror_directory(self, directory=None):
+        """ The wiki mirror of the current server """
+        if directory:
+            return os.path.expanduser(directory)
+        return os.path.join(os.path.expanduser(vim.eval('g:tracWikiMirror')),
+                            re.sub(r'[^\w.-]', '_', self.server_name))
+
+    @command
+    def wiki_export(self, directory=None):
+        """ Downloads the new and changed wiki pages into the mirror """
+        directory = self.mirror_directory(directory)
+        print 'Exporting to {0}...'.format(directory)
+        proxies = [self.make_server_proxy()
+                   for i in xrange(int(vim.eval('g:tracWikiMirrorConnections')))]
+        written, conflicts, removed, failed = self.wiki.export(directory,
+                                                               proxies)
+        print 'Exported {0} pages, removed {1}.'.format(len(written),
+                                                        len(removed))
+        if conflicts:
+            print 'Edited locally, not updated:', ', '.join(conflicts)
+        if failed:
+            print 'Not exported:', ', '.join(failed)
+
+    @command
+    def wiki_import(self, directory=None):
+        """ Saves the wiki pages edited in the mirror """
+        directory = self.mirror_directory(directory)
+        saved, conflicts, failed = self.wiki.import_pages(
+                directory, self.default_comment)
+        print 'Imported {0} pages from {1}.'.format(len(saved), directory)
+        if conflicts:
+            print 'Changed on the server, export first:', ', '.join(conflicts)
+        if failed:
+            print 'Failed:', ', '.join(failed)
+
+    @command
+    def export_tickets(self, path, changelog=False):
+        """ Writes the tickets of the current query to a .jsonl/.csv file """
+        path = os.path.expanduser(path)
+        for done, total in self.ticket.export(path, changelog):
+            vim.command('redraw')
+            print 'Exported {0}/{1} tickets to {2}'.format(done, total, path)
+
+    @command
+    def import_tickets(self):
+        """ creates a ticket for every block in the comment window """
+        if self.uiticket.mode == 0:
+            print "Can't create tickets when not in Ticket View"
+            return
+
+        blocks = self.ticket.parse_import(self.uiticket.commentwindow.dump())
+        new_blocks = [b for b in blocks if not dict(b[0]).get('id')]
+        if not new_blocks:
+            print 'Nothing to import.'
+            return
+
+        if not confirm('Create {0} tickets at {1}?'.format(len(new_blocks),
+                                                           self.server_name)):
+            print 'Ticket import cancelled.'
+            return
+
+        created = self.ticket.bulk_create(blocks)
+        self.uiticket.commentwindow.write(self.ticket.format_import(blocks))
+        self.ticket_list_view()
+        print 'Created {0} tickets, {1} failed.'.format(created,
+                                                        len(new_blocks) - created)
+
+    @command
     def update_ticket(self, option, value=None):
         tid = self.ticket.current_ticket_id
         if self.uiticket.mode == 0 or not tid:
@@ -1175,6 +3971,7 @@ class Trac(object):
         self.ticket.update(comment, attribs, False)
         self.ticket_view(tid, True)
 
+    @command
     def act_ticket(self, action):
         tid = self.ticket.current_ticket_id
         if self.uiticket.mode == 0 or not tid:
@@ -1187,6 +3984,43 @@ class Trac(object):
         self.ticket.act(action, self.uiticket.commentwindow.dump())
         self.ticket_view(tid, True)
 
+    @command
+    def bulk_update_tickets(self, option, args=''):
+        """ applies a field change or an action to every ticket matching the
+            current filters after showing a preview """
+        if self.uiticket.mode == 0:
+            print "Can't update tickets when not in Ticket View"
+            return
+
+        if option == 'action':
+            plan = self.ticket.bulk_plan(action=args)
+        else:
+            try:
+                field, value = args.split(None, 1)
+            except ValueError:
+                print 'Usage: field value'
+                return
+            plan = self.ticket.bulk_plan({field: value})
+        if not plan:
+            print 'No tickets match the current filters'
+            return
+
+        self.uiticket.ticketwindow.write(self.ticket.bulk_report(
+                                         'Bulk update preview', plan))
+        todo = [p for p in plan if p[2] is None]
+        if not todo or not confirm('Update {0} tickets?'.format(len(todo))):
+            print 'Bulk update cancelled.'
+            return
+
+        comment = self.uiticket.commentwindow.dump()
+        results = self.ticket.bulk_update(todo, comment)
+        self.uiticket.ticketwindow.write(self.ticket.bulk_report(
+                                         'Bulk update results', plan, results))
+        self.ticket_list_view()
+        failed = len([r for r in results if r[1] is not None])
+        print 'Updated {0} tickets, {1} failed.'.format(len(results) - failed,
+                                                        failed)
+
     def summary_view(self):
         self.uiticket.summarywindow.create('belowright 10 new')
         self.uiticket.summarywindow.write(self.ticket.get_all(True, False))
@@ -1201,7 +4035,12 @@ class Trac(object):
     def search_open(self, keyword, b_preview=False):
         line = vim.current.line
 
-        if 'Ticket:>>' in line:
+        if line == self.search.more_line.format(len(self.search.results) -
+                                                self.search.shown):
+            cursor = vim.current.window.cursor
+            self.uisearch.searchwindow.write(self.search.more())
+            vim.current.window.cursor = cursor
+        elif 'Ticket:>>' in line:
             self.ticket_view(line.replace('Ticket:>> ', ''))
         elif 'Wiki:>>' in line:
             if b_preview:
@@ -1211,6 +4050,7 @@ class Trac(object):
         elif 'Changeset:>>' in line:
             self.changeset_view(line.replace('Changeset:>> ', ''))
 
+    @command
     def search_view(self, keyword):
         """  run a search """
         print 'Connecting...'
@@ -1226,6 +4066,29 @@ class Trac(object):
         self.uitimeline.open()
         self.uitimeline.timeline_window.write((output_string))
 
+    @command
+    def dashboard_view(self, recount=False):
+        """ Shows the ticket counts, recount fetches them all again """
+        print 'Connecting...'
+        if not self.ticket.attribs:
+            self.ticket.get_attribs()
+        self.dashboard.refresh(recount)
+        self.normal_view()
+        self.uidashboard.open()
+        self.uidashboard.dashboard_window.write(self.dashboard.render())
+
+    def dashboard_select(self):
+        """ Lists the open tickets of the value under the cursor """
+        row = self.dashboard.row(vim.current.window.cursor[0])
+        if not row:
+            return
+        field, value = row
+        self.ticket.filters = {field: query_value(value).encode('utf-8')}
+        if field != 'status':
+            self.ticket.filters['status'] = '!closed'
+        self.ticket.page = 1
+        self.ticket_view()
+
     def get_user(self, server_url=None):
         if not server_url:
             server_url = self.server_url
@@ -1237,24 +4100,27 @@ class Trac(object):
         self.uiticket.normal_mode()
         self.uisearch.normal_mode()
         self.uitimeline.normal_mode()
+        self.uidashboard.normal_mode()
 
+    @command
     def add_attachment(self, file):
         """ add an attachment to current wiki / ticket """
         if self.uiwiki.mode == 1:
             print "Adding attachment to wiki", self.wiki.current_page
-            self.wiki.add_attachment(file)
-            self.wiki_view()
-            print 'Done.'
+            if self.wiki.add_attachment(file):
+                self.wiki_view()
+                print 'Done.'
         elif self.uiticket.mode == 1:
             print "Adding attachment to ticket", self.ticket.current_ticket_id
             comment = self.uiticket.commentwindow.dump()
-            self.ticket.add_attachment(file, comment)
-            self.ticket_view()
-            print 'Done.'
+            if self.ticket.add_attachment(file, comment):
+                self.ticket_view()
+                print 'Done.'
         else:
             print "You need an active ticket or wiki open!"
             return
 
+    @command
     def get_attachment(self, file):
         """ retrieves attachment """
         if file == 'CURRENTLINE':
@@ -1273,16 +4139,32 @@ class Trac(object):
             print "You need an active ticket or wiki open!"
 
     def list_attachments(self):
+        """ attachments of the current wiki page or ticket """
         if self.uiwiki.mode == 1:
-            option = self.wiki.attachments
-            print self.wiki.attachments
+            return self.wiki.attachments
         elif self.uiticket.mode == 1:
-            option = self.ticket.attachments
+            return self.ticket.attachments
+        return []
+
+    def complete(self, kind, typed):
+        """ sets g:tracOptions to the best matches of typed for a command
+            complete """
+        if kind == 'wiki':
+            items = self.wiki.pages or self.wiki.get_all_pages()
+        elif kind == 'attachment':
+            items = self.list_attachments()
+        elif kind == 'search':
+            items = self.search.get_filters()
         else:
-            print "You need an active ticket or wiki open!"
+            items = self.ticket.options(kind)
 
-        vim.command('let g:tracOptions = "' + "|".join(option) + '"')
+        index = self.completions.setdefault(kind, CompletionIndex())
+        index.update(items)
+        limit = int(vim.eval('g:tracCompletionLimit'))
+        vim.command('let g:tracOptions = {0}'.format(
+                    vim_list(index.complete(to_unicode(typed), limit))))
 
+    @command
     def preview(self, b_dump=False):
         """ browser view of current wiki buffer """
         if self.uiwiki.mode == 1 and self.wiki.current_page:
@@ -1313,16 +4195,39 @@ class Trac(object):
             browser = vim.eval('g:tracBrowser')
             vim.command('!{0} file://{1}'.format(browser, file_name))
 
+    def profile(self, command):
+        """ Runs an ex command and prints how long its phases took. With
+            g:tracProfileFile set the cProfile statistics are written there """
+        output = vim.eval('g:tracProfileFile')
+        profile = cProfile.Profile() if output else None
+        profiler.start()
+        try:
+            if profile:
+                profile.runcall(vim.command, command)
+            else:
+                vim.command(command)
+        finally:
+            total = profiler.stop()
+        if profile:
+            with open(os.path.expanduser(output), 'w') as fp:
+                stats = pstats.Stats(profile, stream=fp)
+                stats.sort_stats('cumulative').print_stats()
+        print profiler.summary(total)
+
     def changeset_view(self, changeset):
         print 'Connecting...'
-        changeset = '{scheme}://{server}/changeset/{changeset}'.format(
-                changeset=changeset, **self.server_url)
+        key = ('changeset', changeset)
+        diff = self.cache.get(key)
+        if diff is None:
+            diff = self.session.open('/changeset/{0}?format=diff'.format(
+                                     changeset)).read()
+            self.cache.put(key, diff)
 
         self.normal_view()
         vim.command('belowright split')
         vim.command('enew')
         vim.command("setlocal buftype=nofile")
-        vim.command('silent Nread ' + changeset + '?format=diff')
+        vim.current.buffer[:] = diff.splitlines()
         vim.command('set ft=diff')
 
 
@@ -169,6 +169,12 @@ if !exists('g:tracTicketBriefDescription')
     let g:tracTicketBriefDescription = 1
 endif
 
+"Number of changelog entries rendered when a ticket is opened, wh in the
+"ticket window shows that many more
+if !exists('g:tracTicketChangelogLimit')
+    let g:tracTicketChangelogLimit = 20
+endif
+
 
 "Layouts can be modified here
 if !exists('g:tracWikiStyle')
@@ -189,6 +195,121 @@ if !exists('g:tracUseTab')
     let g:tracUseTab = 1
 endif
 
+"Server metadata (milestones, components, ticket fields...) is cached here
+if !exists('g:tracCacheDirectory')
+    let g:tracCacheDirectory = expand('$HOME') . '/.vimtrac_cache'
+endif
+
+"Seconds before cached server metadata is refreshed in the background
+if !exists('g:tracMetadataTTL')
+    let g:tracMetadataTTL = 86400
+endif
+
+"Reopen the last server, ticket and wiki page with their history, filters and
+"sorting, painting the views from the last session before refreshing them
+if !exists('g:tracRestoreSession')
+    let g:tracRestoreSession = 1
+endif
+
+"Maximum number of matches offered by <tab> completion
+if !exists('g:tracCompletionLimit')
+    let g:tracCompletionLimit = 50
+endif
+
+"Seconds between polls for changes to visited and watched tickets and pages,
+"doubling up to g:tracWatchMaxInterval while nothing changes. 0 disables it
+if !exists('g:tracWatchInterval')
+    let g:tracWatchInterval = 30
+endif
+
+if !exists('g:tracWatchMaxInterval')
+    let g:tracWatchMaxInterval = 600
+endif
+
+"Directory of the :TWExport/:TWImport wiki mirrors, one subdirectory per server
+if !exists('g:tracWikiMirror')
+    let g:tracWikiMirror = expand('$HOME') . '/trac_wiki'
+endif
+
+"Connections used to download pages in parallel by :TWExport
+if !exists('g:tracWikiMirrorConnections')
+    let g:tracWikiMirrorConnections = 4
+endif
+
+"Pages linked from the open wiki page fetched in the background, 0 disables
+if !exists('g:tracWikiPrefetchLinks')
+    let g:tracWikiPrefetchLinks = 10
+endif
+
+"Kilobytes of tickets, changelogs, wiki revisions, changesets and previews
+"kept in memory, the least recently used are dropped first
+if !exists('g:tracCacheSize')
+    let g:tracCacheSize = 8192
+endif
+
+"Seconds those are kept at most, 0 keeps them until they are dropped
+if !exists('g:tracCacheTTL')
+    let g:tracCacheTTL = 0
+endif
+
+"Number of pages and tickets remembered for the history navigation
+if !exists('g:tracHistoryLimit')
+    let g:tracHistoryLimit = 100
+endif
+
+"Seconds to wait for a server to accept a connection and to send each part
+"of a response. Servers can override them with 'connect_timeout' and
+"'read_timeout' in g:tracServerList
+if !exists('g:tracConnectTimeout')
+    let g:tracConnectTimeout = 10
+endif
+
+if !exists('g:tracReadTimeout')
+    let g:tracReadTimeout = 60
+endif
+
+"Times a read that failed on the network is retried
+if !exists('g:tracRetries')
+    let g:tracRetries = 2
+endif
+
+"Number of search results shown at first and added by each <enter> on the
+"'more results' line
+if !exists('g:tracSearchPageSize')
+    let g:tracSearchPageSize = 50
+endif
+
+"Share connections and fetched data between vim instances through a helper
+"process, trac_daemon.py, which is started on demand. It answers identical
+"reads of any vim from memory for g:tracDaemonTTL seconds
+if !exists('g:tracDaemon')
+    let g:tracDaemon = 0
+endif
+
+if !exists('g:tracDaemonTTL')
+    let g:tracDaemonTTL = 30
+endif
+
+if !exists('g:tracDaemonSocket')
+    let g:tracDaemonSocket = g:tracCacheDirectory . '/daemon.sock'
+endif
+
+if !exists('g:tracDaemonPython')
+    let g:tracDaemonPython = 'python2'
+endif
+
+let g:tracDaemonScript = expand('<sfile>:p:h') . '/trac_daemon.py'
+
+":TracProfile also writes the full cProfile statistics to this file when set
+if !exists('g:tracProfileFile')
+    let g:tracProfileFile = ''
+endif
+
+"Number of calls sent in one MultiCall request by the bulk commands
+if !exists('g:tracBatchSize')
+    let g:tracBatchSize = 50
+endif
+
 "Leader Short CUTS (Uncomment or add and customise to yout vimrc)
 "Open Wiki
 " map <leader>to :TWOpen<cr>
@@ -225,6 +346,8 @@ let g:tracDefaultView = 'wiki' " 'ticket' 'timeline'
 com! -nargs=+ -complete=customlist,ComTracServers TracServer  python trac.set_server(<q-args>)
 
 com! -nargs=? -complete=customlist,ComWiki TWOpen python trac.wiki_view(<f-args>)
+com! -nargs=? -complete=dir TWExport python trac.wiki_export(<f-args>)
+com! -nargs=? -complete=dir TWImport python trac.wiki_import(<f-args>)
 
 fun LoadWikiCommands()
     "NOTE: TWSave is referenced in trac.py
@@ -234,7 +357,9 @@ fun LoadWikiCommands()
     "HTML Preview/Dumps
     com! -nargs=0                                     TWPreview       python trac.preview(False)
     com! -nargs=0                                     TWDump          python trac.preview(True)
-    com! -nargs=?                                     TWVimDiff       python trac.wiki.vim_diff(<f-args>)
+    com! -nargs=?                                     TWVimDiff       python trac.wiki_diff(<f-args>)
+    com! -nargs=0                                     TWHistory       python trac.wiki_history()
+    com! -nargs=0                                     TWBacklinks     python trac.wiki_backlinks()
     com! -nargs=0                                     TWInfo          python print trac.wiki.get_page_info()
 endfun
 
@@ -246,6 +371,8 @@ fun UnloadWikiCommands()
         delc TWPreview
         delc TWDump
         delc TWVimDiff
+        delc TWHistory
+        delc TWBacklinks
         delc TWInfo
     endtry
 endfun
@@ -259,6 +386,8 @@ fun LoadTicketCommands()
     com! -nargs=+                                     TTCreateTask        python trac.create_ticket('task', <q-args>)
     com! -nargs=+                                     TTCreateDefect      python trac.create_ticket('defect', <q-args>)
     com! -nargs=+                                     TTCreateEnhancement python trac.create_ticket('enhancement', <q-args>)
+    com! -nargs=0                                     TTImport            python trac.import_tickets()
+    com! -nargs=1 -bang -complete=file                TTExport            python trac.export_tickets(<q-args>, '<bang>' == '!')
 
     com! -nargs=0                                     TTSetSummary        python trac.update_ticket('summary')
     com! -nargs=0                                     TTUpdateDescrption  python trac.update_ticket('description')
@@ -317,6 +446,10 @@ fun LoadTicketCommands()
     com! -nargs=0                                     TTPreview           python trac.preview()
 
     com! -nargs=+ -complete=customlist,ComAction      TTAction            python trac.act_ticket(<q-args>)
+
+    "Bulk changes to every ticket matching the current filters
+    com! -nargs=+ -complete=customlist,ComSort        TTBulkSet           python trac.bulk_update_tickets('field', <q-args>)
+    com! -nargs=+ -complete=customlist,ComAction      TTBulkAction        python trac.bulk_update_tickets('action', <q-args>)
 endfun
 
 fun UnloadTicketCommands()
@@ -325,6 +458,8 @@ fun UnloadTicketCommands()
         delc TTCreateTask
         delc TTCreateDefect
         delc TTCreateEnhancement
+        delc TTImport
+        delc TTExport
         delc TTAddComment
         "Ticket Attributes
         delc TTSetMilestone
@@ -372,81 +507,95 @@ fun UnloadTicketCommands()
         delc TTPreview
 
         delc TTAction
+
+        delc TTBulkSet
+        delc TTBulkAction
     endtry
 endfun
 
 "MISCELLANEOUS
-com! -nargs=+ TSearch         python trac.search_view(<q-args>)
+com! -nargs=+ -complete=customlist,ComSearch TSearch python trac.search_view(<q-args>)
 com! -nargs=1 TChangesetOpen  python trac.changeset_view(<f-args>)
 com! -nargs=0 TTimelineOpen   python trac.timeline_view()
+com! -nargs=0 -bang TracDashboard python trac.dashboard_view('<bang>' == '!')
 com! -nargs=0 TClose          python trac.normal_view(<f-args>)
+com! -nargs=0 TracCacheStats  python print trac.cache.stats()
+com! -nargs=+ -complete=command TracProfile python trac.profile(<q-args>)
+com! -nargs=? TTWatch         python trac.watch('ticket', <f-args>)
+com! -nargs=? -complete=customlist,ComWiki TWWatch python trac.watch('wiki', <q-args>)
+
+"Changed tickets and pages reported by the watcher, for the statusline:
+"   set statusline+=%{TracWatchStatus()}
+let g:tracWatchStatus = ''
+
+fun TracWatchStatus()
+    return g:tracWatchStatus
+endfun
 
 "FUNCTION COMPLETES
 fun ComTracServers(A, L, P)
     return filter(keys(g:tracServerList), 'v:val =~ "^' . a:A . '"')
 endfun
 
-let g:tracOptions = 1
+let g:tracOptions = []
+
+"Ranked matches for a:A computed by trac.py
+fun TracComplete(kind, A)
+    python trac.complete(vim.eval('a:kind'), vim.eval('a:A'))
+    return g:tracOptions
+endfun
 
 fun ComAttachments(A, L, P)
-    python trac.list_attachments()
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('attachment', a:A)
 endfun
 
 fun ComWiki(A, L, P)
-    python trac.wiki.get_options()
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('wiki', a:A)
+endfun
+
+fun ComSearch(A, L, P)
+    return TracComplete('search', a:A)
 endfun
 
 "COMMAND COMPLETES
 fun ComMilestone(A, L, P)
-    python trac.ticket.get_options(0)
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('milestone', a:A)
 endfun
 
 fun ComType(A, L, P)
-    python trac.ticket.get_options(1)
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('type', a:A)
 endfun
 
 fun ComStatus(A, L, P)
-    python trac.ticket.get_options(2)
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('status', a:A)
 endfun
 
 fun ComResolution(A, L, P)
-    python trac.ticket.get_options(3)
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('resolution', a:A)
 endfun
 
 fun ComPriority(A, L, P)
-    python trac.ticket.get_options(4)
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('priority', a:A)
 endfun
 
 fun ComSeverity(A, L, P)
-    python trac.ticket.get_options(5)
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('severity', a:A)
 endfun
 
 fun ComComponent(A, L, P)
-    python trac.ticket.get_options(6)
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('component', a:A)
 endfun
 
 fun ComVersion(A, L, P)
-    python trac.ticket.get_options(7)
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('version', a:A)
 endfun
 
 fun ComSort(A, L, P)
-    python trac.ticket.get_options(type_='field')
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('field', a:A)
 endfun
 
 fun ComAction(A, L, P)
-    python trac.ticket.get_options(type_='action')
-    return filter(split(g:tracOptions, '|'), 'v:val =~ "^' . a:A . '"')
+    return TracComplete('action', a:A)
 endfun
 
 
@@ -473,6 +622,27 @@ fun TracCloseViewCallback()
     return 1
 endfun
 
+"Background work hands its results to vim through trac.process_pending(),
+"a one-shot timer is started only while there is work to wait for
+fun TracProcessPending(...)
+    python trac.process_pending()
+endfun
+
+fun TracSchedulePending(delay)
+    if !has('timers')
+        return -1
+    endif
+    return timer_start(a:delay, 'TracProcessPending')
+endfun
+
 python trac_init()
 
+augroup TracVim
+    autocmd!
+    autocmd VimLeavePre * python trac.save_session()
+    if !has('timers')
+        autocmd CursorHold,CursorHoldI * call TracProcessPending()
+    endif
+augroup END
+
 let g:tracvim_loaded = 1
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+trac_daemon.py - Shares Trac connections and results between vim instances
+
+Started by trac.vim when g:tracDaemon is set. It listens on a unix socket for
+the xmlrpc requests of the plugin and forwards them to the Trac server given
+in their X-Trac-Upstream header, over up to --connections connections per
+server at once. Identical reads from any vim are answered from memory for up
+to --ttl seconds, writes drop what was remembered about their ticket or page.
+It exits after --idle seconds without requests.
+"""
+import os
+import json
+import time
+import zlib
+import socket
+import threading
+import argparse
+import xmlrpclib
+import SocketServer
+import BaseHTTPServer
+
+import trac
+
+
+class DaemonHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers the xmlrpc requests of one vim connection """
+    def do_POST(self):
+        self.server.last_request = time.time()
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        upstream = trac.xmlrpc_strings(json.loads(
+                   self.headers['X-Trac-Upstream']))
+        params, method = xmlrpclib.loads(body)
+        try:
+            result = self.server.call(upstream, method, params)
+            response = xmlrpclib.dumps((result, ), methodresponse=True,
+                                       allow_none=True)
+        except xmlrpclib.Fault, fault:
+            response = xmlrpclib.dumps(fault, methodresponse=True)
+        except Exception, e:
+            self.send_error(502, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Keeps a pool of RequestScopes per Trac server, one per connection.
+        They share a memo which is dropped every ttl seconds. Up to
+        connections requests to one server are sent at once """
+    daemon_threads = True
+    timeout = 10
+
+    def __init__(self, path, ttl, idle, connections):
+        SocketServer.UnixStreamServer.__init__(self, path, DaemonHandler)
+        self.ttl = ttl
+        self.idle = idle
+        self.connections = connections
+        self.scopes = {}
+        self.lock = threading.Lock()
+        self.last_request = time.time()
+
+    def call(self, upstream, method, params):
+        key = json.dumps(upstream, sort_keys=True)
+        with self.lock:
+            if key not in self.scopes:
+                self.scopes[key] = {
+                    'idle': [], 'memo': {}, 'time': time.time(),
+                    'slots': threading.Semaphore(self.connections)}
+            entry = self.scopes[key]
+            if time.time() - entry['time'] > self.ttl:
+                entry['memo'] = {}
+                entry['time'] = time.time()
+        with entry['slots']:
+            with self.lock:
+                if entry['idle']:
+                    scope = entry['idle'].pop()
+                else:
+                    scope = trac.RequestScope(trac.server_proxy(upstream))
+                    scope.depth = 1
+                scope.memo = entry['memo']
+            try:
+                return scope.call(method, params)
+            finally:
+                with self.lock:
+                    entry['idle'].append(scope)
+
+    def serve(self):
+        while time.time() - self.last_request < self.idle:
+            self.handle_request()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('socket', help='path of the unix socket')
+    parser.add_argument('--ttl', type=float, default=30,
+                        help='seconds reads are answered from memory')
+    parser.add_argument('--idle', type=float, default=3600,
+                        help='seconds without requests before exiting')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='requests sent to one server at once')
+    args = parser.parse_args()
+
+    # a socket left behind by a daemon that died is in the way
+    try:
+        socket.socket(socket.AF_UNIX).connect(args.socket)
+        return
+    except socket.error:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+    os.umask(077)
+    server = DaemonServer(args.socket, args.ttl, args.idle, args.connections)
+    try:
+        server.serve()
+    finally:
+        os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()